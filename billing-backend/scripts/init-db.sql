@@ -41,6 +41,9 @@ CREATE TABLE IF NOT EXISTS plans (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Containment index for active trial plan lookups (features @> '{"trial": true}')
+CREATE INDEX IF NOT EXISTS idx_plans_trial_gin ON plans USING GIN (features jsonb_path_ops) WHERE is_active;
+
 -- Subscriptions table
 CREATE TABLE IF NOT EXISTS subscriptions (
     id UUID DEFAULT uuid_generate_v4() PRIMARY KEY,
@@ -57,6 +60,8 @@ CREATE TABLE IF NOT EXISTS subscriptions (
 -- Create indexes for subscriptions
 CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id);
 CREATE INDEX IF NOT EXISTS idx_subscriptions_status ON subscriptions(status);
+CREATE INDEX IF NOT EXISTS idx_sub_past_due ON subscriptions(id) WHERE status = 'past_due';
+CREATE INDEX IF NOT EXISTS idx_sub_active_end ON subscriptions(end_date) WHERE status IN ('active', 'trial');
 CREATE INDEX IF NOT EXISTS idx_subscriptions_end_date ON subscriptions(end_date);
 
 -- Subscription events table for audit trail
@@ -82,6 +87,7 @@ CREATE TABLE IF NOT EXISTS payment_webhook_requests (
     id SERIAL PRIMARY KEY,
     event_id VARCHAR(255) UNIQUE NOT NULL,
     payload JSONB NOT NULL,
+    content_hash VARCHAR(32),
     processed BOOLEAN DEFAULT FALSE NOT NULL,
     processed_at TIMESTAMP WITH TIME ZONE,
     error_message TEXT,
@@ -93,6 +99,8 @@ CREATE TABLE IF NOT EXISTS payment_webhook_requests (
 -- Create indexes for webhook requests
 CREATE INDEX IF NOT EXISTS idx_webhook_requests_event_id ON payment_webhook_requests(event_id);
 CREATE INDEX IF NOT EXISTS idx_webhook_requests_processed ON payment_webhook_requests(processed);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_requests_content_hash ON payment_webhook_requests(content_hash);
+CREATE INDEX IF NOT EXISTS idx_webhook_pending ON payment_webhook_requests(retry_count) WHERE processed IS FALSE;
 
 -- Transactions table (for payment service)
 CREATE TABLE IF NOT EXISTS transactions (
@@ -147,13 +155,11 @@ CREATE TABLE IF NOT EXISTS user_usage (
     usage_count INTEGER DEFAULT 0,
     reset_at TIMESTAMP WITH TIME ZONE NOT NULL,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    CONSTRAINT unique_user_feature UNIQUE (user_id, feature_name)
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
--- Create indexes for user usage
-CREATE INDEX IF NOT EXISTS idx_user_usage_user_id ON user_usage(user_id);
-CREATE INDEX IF NOT EXISTS idx_user_usage_feature_name ON user_usage(feature_name);
+-- Create indexes for user usage (the composite unique index also serves user_id lookups)
+CREATE UNIQUE INDEX IF NOT EXISTS ix_user_usage_user_feature ON user_usage(user_id, feature_name);
 CREATE INDEX IF NOT EXISTS idx_user_usage_reset_at ON user_usage(reset_at);
 
 -- Insert seed data
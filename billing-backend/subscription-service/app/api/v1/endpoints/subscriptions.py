@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from uuid import UUID
@@ -10,7 +11,8 @@ from app.schemas.subscription import (
     TrialSubscriptionRequest,
     PlanChangeRequest,
     SubscriptionResponse,
-    SubscriptionListResponse
+    SubscriptionListResponse,
+    stream_subscription_rows
 )
 from app.schemas.common import SuccessResponse, ErrorResponse
 from app.services.subscription_service import SubscriptionService
@@ -139,10 +141,9 @@ async def get_user_subscriptions(
         service = SubscriptionService(session)
         subscriptions = await service.get_user_subscriptions(current_user.id)
         
-        return [
-            SubscriptionResponse.from_orm(subscription, include_plan=True) 
-            for subscription in subscriptions
-        ]
+        # Build rows here so a failure is still a 500; only encoding is streamed
+        rows = [SubscriptionResponse.from_orm(sub, include_plan=True) for sub in subscriptions]
+        return StreamingResponse(stream_subscription_rows(rows), media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to retrieve subscriptions")
 
@@ -230,10 +231,9 @@ async def get_user_subscriptions_internal(
         service = SubscriptionService(session)
         subscriptions = await service.get_user_subscriptions(user_id)
         
-        return [
-            SubscriptionResponse.from_orm(subscription, include_plan=True) 
-            for subscription in subscriptions
-        ]
+        # Build rows here so a failure is still a 500; only encoding is streamed
+        rows = [SubscriptionResponse.from_orm(sub, include_plan=True) for sub in subscriptions]
+        return StreamingResponse(stream_subscription_rows(rows), media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to retrieve subscriptions")
 
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from datetime import datetime, timedelta
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 
@@ -78,8 +79,6 @@ async def get_feature_usage(
         
         if not usage:
             # Return zero usage if no record exists
-            from app.schemas.usage import UsageResponse
-            from datetime import datetime, timedelta
             return UsageResponse(
                 user_id=current_user.id,
                 feature_name=feature_name,
@@ -128,7 +127,8 @@ async def get_usage_stats(
         service = UsageService(session)
         stats = await service.get_usage_stats(current_user.id)
         
-        return stats
+        # Pre-serialized with orjson; response_model is kept for the OpenAPI schema
+        return Response(content=stats.to_orjson_bytes(), media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to retrieve usage statistics")
 
@@ -170,8 +170,6 @@ async def get_user_feature_usage_internal(
         
         if not usage:
             # Return zero usage if no record exists
-            from app.schemas.usage import UsageResponse
-            from datetime import datetime, timedelta
             return UsageResponse(
                 user_id=user_id,
                 feature_name=feature_name,
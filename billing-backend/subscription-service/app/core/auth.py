@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
@@ -137,4 +138,18 @@ def create_service_token(service_name: str) -> str:
         "type": "service",
         "service": service_name
     }
-    return AuthService.create_access_token(data, expires_delta=timedelta(hours=24)) 
\ No newline at end of file
+    return AuthService.create_access_token(data, expires_delta=timedelta(hours=24))
+
+
+# Service tokens are valid for 24 hours; reuse each for an hour instead of
+# signing a new one for every outbound call
+_service_tokens: TTLCache = TTLCache(maxsize=8, ttl=3600)
+
+
+def get_service_token(service_name: str) -> str:
+    """Return a cached service-to-service token, creating one when absent or stale."""
+    token = _service_tokens.get(service_name)
+    if token is None:
+        token = create_service_token(service_name)
+        _service_tokens[service_name] = token
+    return token
@@ -1,7 +1,10 @@
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.pool import StaticPool
-from typing import AsyncGenerator
+from sqlalchemy import text, event
+from contextvars import ContextVar
+from typing import AsyncGenerator, List, Optional
+import asyncio
 import logging
 
 from app.core.config import settings
@@ -13,10 +16,33 @@ engine = create_async_engine(
     settings.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://"),
     pool_size=settings.DATABASE_POOL_SIZE,
     max_overflow=settings.DATABASE_MAX_OVERFLOW,
-    pool_pre_ping=True,
+    pool_pre_ping=settings.DATABASE_POOL_PRE_PING,
+    pool_recycle=settings.DATABASE_POOL_RECYCLE,
+    query_cache_size=settings.DATABASE_QUERY_CACHE_SIZE,
     echo=settings.DEBUG,
+    # JIT compilation only slows down the short OLTP queries this service runs
+    connect_args={"server_settings": {"jit": "off"}},
 )
 
+# Per-request query counter; a mutable holder so tasks spawned by
+# asyncio.gather (which copy the context) still add to the same total
+_query_counter: ContextVar[Optional[List[int]]] = ContextVar("query_counter", default=None)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def start_query_count() -> List[int]:
+    """Start counting queries issued from the current context."""
+    counter = [0]
+    _query_counter.set(counter)
+    return counter
+
+
 # Create session factory
 AsyncSessionLocal = async_sessionmaker(
     engine,
@@ -61,6 +87,19 @@ class DatabaseManager:
             logger.error(f"Error creating database tables: {e}")
             raise
     
+    @staticmethod
+    async def warm_pool():
+        """Open pool_size connections up front so early requests don't pay connection setup."""
+        async def _checkout():
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        
+        try:
+            await asyncio.gather(*(_checkout() for _ in range(settings.DATABASE_POOL_SIZE)))
+            logger.info(f"Database pool warmed with {settings.DATABASE_POOL_SIZE} connections")
+        except Exception as e:
+            logger.error(f"Error warming database pool: {e}")
+    
     @staticmethod
     async def close_connections():
         """Close all database connections."""
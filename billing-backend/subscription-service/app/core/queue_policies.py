@@ -38,4 +38,5 @@ QUEUE_POLICIES: Dict[str, QueuePolicy] = {
     ),
     "q:sub:plan_change": DEFAULT_POLICY,
     "q:sub:usage_sync": DEFAULT_POLICY,
+    "q:sub:webhook_processing": DEFAULT_POLICY,
 } 
\ No newline at end of file
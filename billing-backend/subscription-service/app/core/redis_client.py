@@ -1,6 +1,7 @@
-import json
 import time
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+import msgspec
+import orjson
 import redis.asyncio as redis
 from redis.asyncio import ConnectionPool
 import logging
@@ -10,6 +11,108 @@ from app.core.config import settings
 logger = logging.getLogger(__name__)
 
 
+# Atomically move due messages from a delayed ZSET to its main list.
+# Messages stay opaque strings; LIMIT keeps unpack() below Lua's stack limit.
+MOVE_READY_DELAYED_LUA = """
+    local ready = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1], 'LIMIT', 0, ARGV[2])
+    if #ready > 0 then
+        redis.call('ZREM', KEYS[1], unpack(ready))
+        redis.call('LPUSH', KEYS[2], unpack(ready))
+    end
+    return #ready
+"""
+MOVE_READY_DELAYED_BATCH = 1000
+
+# Pop ready members of a delayed zset and return them, atomically
+POP_READY_DELAYED_LUA = """
+    local ready = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1], 'LIMIT', 0, ARGV[2])
+    if #ready > 0 then
+        redis.call('ZREM', KEYS[1], unpack(ready))
+    end
+    return ready
+"""
+
+# Claim a message (main -> :processing) and take its lock in one step. The
+# lock is keyed by the envelope "id" (sha1 of the raw message otherwise);
+# if it is held the message goes back to the main queue untouched.
+# Returns nil when empty, {"locked", lock_key} or {"ok", message, lock_key}.
+CLAIM_AND_LOCK_LUA = """
+    local m = redis.call('RPOP', KEYS[1])
+    if not m then
+        return nil
+    end
+    local ok, decoded = pcall(cjson.decode, m)
+    local mid = nil
+    if ok and type(decoded) == 'table' then
+        local id = decoded['id']
+        if type(id) == 'string' or type(id) == 'number' then
+            mid = tostring(id)
+        end
+    end
+    local lock_key = ARGV[1] .. (mid or redis.sha1hex(m))
+    if not redis.call('SET', lock_key, '1', 'NX', 'EX', ARGV[2]) then
+        redis.call('LPUSH', KEYS[1], m)
+        return {'locked', lock_key}
+    end
+    redis.call('LPUSH', KEYS[2], m)
+    return {'ok', m, lock_key}
+"""
+
+# List of "user_id:feature_name:count" entries written by atomic_usage_check
+USAGE_DIRTY_KEY = "usage:dirty"
+
+# Outbox list of serialized subscription events awaiting a bulk insert
+SUBSCRIPTION_EVENTS_KEY = "events:subscription"
+
+# Recorded payment webhooks awaiting processing (WEBHOOK_ASYNC_PROCESSING)
+WEBHOOK_PROCESSING_QUEUE = "q:sub:webhook_processing"
+
+# Check-and-increment a usage hash; on success append "user_id:feature:count"
+# to the dirty list so the database sync happens in the same round trip.
+ATOMIC_USAGE_LUA = """
+    local key = KEYS[1]
+    local limit = tonumber(ARGV[1])
+    local delta = tonumber(ARGV[2])
+    local reset_at = ARGV[3]
+    local current_time = ARGV[4]
+    
+    local current = redis.call('HMGET', key, 'count', 'reset_at')
+    local count = tonumber(current[1]) or 0
+    local stored_reset = current[2]
+    
+    -- Check if expired
+    if stored_reset and stored_reset <= current_time then
+        count = 0
+    end
+    
+    -- Check limit
+    if count + delta > limit then
+        return {0, count, limit} -- limit exceeded
+    end
+    
+    -- Increment
+    count = count + delta
+    redis.call('HMSET', key, 'count', count, 'reset_at', reset_at)
+    redis.call('EXPIRE', key, 86400) -- 24h TTL
+    
+    -- Record the new count for the deferred database sync
+    redis.call('RPUSH', KEYS[2], ARGV[5] .. ':' .. count)
+    
+    -- Track the feature in the user's feature set so resets need no keyspace scan
+    redis.call('SADD', KEYS[3], ARGV[6])
+    redis.call('EXPIRE', KEYS[3], 86400)
+    
+    return {1, count, limit} -- success
+"""
+
+
+def dump_message(message: Union[Dict[str, Any], msgspec.Struct]) -> bytes:
+    """Serialize a queue message; typed structs use msgspec, dicts use orjson (str fallback)."""
+    if isinstance(message, msgspec.Struct):
+        return msgspec.json.encode(message)
+    return orjson.dumps(message, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
 class RedisClient:
     """
     Redis client for queue management and atomic operations.
@@ -22,11 +125,20 @@ class RedisClient:
             decode_responses=True
         )
         self.client: Optional[redis.Redis] = None
+        self._move_ready_delayed = None
+        self._pop_ready_delayed = None
+        self._claim_and_lock = None
+        self._atomic_usage = None
     
     async def connect(self):
         """Initialize Redis connection."""
         try:
             self.client = redis.Redis(connection_pool=self.pool)
+            # EVALSHA wrapper; redis-py loads the script on first use / NOSCRIPT
+            self._move_ready_delayed = self.client.register_script(MOVE_READY_DELAYED_LUA)
+            self._pop_ready_delayed = self.client.register_script(POP_READY_DELAYED_LUA)
+            self._claim_and_lock = self.client.register_script(CLAIM_AND_LOCK_LUA)
+            self._atomic_usage = self.client.register_script(ATOMIC_USAGE_LUA)
             # Test connection
             await self.client.ping()
             logger.info("Redis connection established")
@@ -40,15 +152,24 @@ class RedisClient:
             await self.client.aclose()
             logger.info("Redis connection closed")
     
-    async def queue_message(self, queue_name: str, message: Dict[str, Any]):
+    async def queue_message(self, queue_name: str, message: Union[Dict[str, Any], msgspec.Struct]):
         """Add message to queue."""
         try:
-            await self.client.lpush(queue_name, json.dumps(message, default=str))
+            await self.client.lpush(queue_name, dump_message(message))
             logger.debug(f"Message queued to {queue_name}")
         except Exception as e:
             logger.error(f"Failed to queue message to {queue_name}: {e}")
             raise
     
+    async def queue_raw(self, queue_name: str, raw: Union[bytes, str]):
+        """Push an already-serialized message to a queue without re-encoding it."""
+        try:
+            await self.client.lpush(queue_name, raw)
+            logger.debug(f"Raw message queued to {queue_name}")
+        except Exception as e:
+            logger.error(f"Failed to queue raw message to {queue_name}: {e}")
+            raise
+    
     async def claim_message(self, main_queue: str, processing_queue: str, timeout: int = 1) -> Optional[str]:
         """Atomically claim a message from main_queue into processing_queue (BRPOPLPUSH)."""
         try:
@@ -65,12 +186,34 @@ class RedisClient:
             logger.error(f"Failed to remove from {processing_queue}: {e}")
             return 0
     
-    async def queue_delayed_message(self, queue_name: str, message: Dict[str, Any], delay_seconds: int):
+    async def claim_and_lock_batch(self, queues: Dict[str, int]) -> Dict[str, Optional[List[str]]]:
+        """
+        Claim and lock one message per queue ({main_queue: lock_ttl}) in one pipelined round trip.
+        
+        Each value is None for an empty queue, ["locked", lock_key] when the
+        message's lock is held elsewhere, or ["ok", message, lock_key].
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for main_queue, lock_ttl in queues.items():
+            await self._claim_and_lock(
+                keys=[main_queue, f"{main_queue}:processing"],
+                args=[f"lock:{main_queue}:", lock_ttl],
+                client=pipe
+            )
+        return dict(zip(queues, await pipe.execute()))
+    
+    async def claim_and_lock(self, main_queue: str, lock_ttl: int) -> Optional[List[str]]:
+        """Claim and lock one message from main_queue (see claim_and_lock_batch)."""
+        claimed = await self.claim_and_lock_batch({main_queue: lock_ttl})
+        return claimed.get(main_queue)
+    
+    async def queue_delayed_message(self, queue_name: str, message: Union[Dict[str, Any], msgspec.Struct], delay_seconds: int):
         """Add message to delayed queue (ZSET with timestamp score)."""
         try:
             delayed_queue = f"{queue_name}:delayed"
-            score = time.time() + delay_seconds
-            await self.client.zadd(delayed_queue, {json.dumps(message, default=str): score})
+            # Whole epoch seconds: shared wall clock across processes, compact score strings
+            score = int(time.time()) + int(delay_seconds)
+            await self.client.zadd(delayed_queue, {dump_message(message): score})
             logger.debug(f"Delayed message queued to {delayed_queue} with delay {delay_seconds}s")
         except Exception as e:
             logger.error(f"Failed to queue delayed message: {e}")
@@ -78,33 +221,40 @@ class RedisClient:
     
     async def move_ready_delayed_to_main(self, queue_name: str) -> int:
         """Move ready messages from delayed zset back to main queue."""
+        moved = await self.move_ready_delayed_batch([queue_name])
+        return moved.get(queue_name, 0)
+    
+    async def move_ready_delayed_batch(self, queue_names: Sequence[str]) -> Dict[str, int]:
+        """Move ready delayed messages for several queues in one pipelined round trip."""
         try:
-            delayed_queue = f"{queue_name}:delayed"
-            now = time.time()
-            messages = await self.client.zrangebyscore(delayed_queue, 0, now)
-            moved = 0
-            for msg in messages:
-                await self.client.lpush(queue_name, msg)
-                moved += 1
-            if messages:
-                await self.client.zremrangebyscore(delayed_queue, 0, now)
-            return moved
+            now = int(time.time())
+            pipe = self.client.pipeline(transaction=False)
+            for queue_name in queue_names:
+                await self._move_ready_delayed(
+                    keys=[f"{queue_name}:delayed", queue_name],
+                    args=[now, MOVE_READY_DELAYED_BATCH],
+                    client=pipe
+                )
+            counts = await pipe.execute()
+            return dict(zip(queue_names, (int(count) for count in counts)))
         except Exception as e:
-            logger.error(f"Failed moving delayed for {queue_name}: {e}")
-            return 0
+            logger.error(f"Failed moving delayed messages for {queue_names}: {e}")
+            return {}
     
     async def get_ready_delayed_messages(self, queue_name: str) -> List[str]:
         """Get messages from delayed queue that are ready to process."""
         try:
             delayed_queue = f"{queue_name}:delayed"
-            current_time = time.time()
+            current_time = int(time.time())
             
-            # Get ready messages
-            messages = await self.client.zrangebyscore(delayed_queue, 0, current_time)
+            # Read and remove in one script so members delayed concurrently are
+            # neither dropped nor handed to two callers
+            messages = await self._pop_ready_delayed(
+                keys=[delayed_queue],
+                args=[current_time, MOVE_READY_DELAYED_BATCH]
+            )
             
             if messages:
-                # Remove them from delayed queue
-                await self.client.zremrangebyscore(delayed_queue, 0, current_time)
                 logger.debug(f"Retrieved {len(messages)} ready messages from {delayed_queue}")
             
             return messages
@@ -118,45 +268,11 @@ class RedisClient:
         Atomic usage check and increment using Lua script.
         Returns: {'success': bool, 'current_usage': int, 'limit': int}
         """
-        lua_script = """
-            local key = KEYS[1]
-            local limit = tonumber(ARGV[1])
-            local delta = tonumber(ARGV[2])
-            local reset_at = ARGV[3]
-            local current_time = ARGV[4]
-            
-            local current = redis.call('HMGET', key, 'count', 'reset_at')
-            local count = tonumber(current[1]) or 0
-            local stored_reset = current[2]
-            
-            -- Check if expired
-            if stored_reset and stored_reset <= current_time then
-                count = 0
-            end
-            
-            -- Check limit
-            if count + delta > limit then
-                return {0, count, limit} -- limit exceeded
-            end
-            
-            -- Increment
-            count = count + delta
-            redis.call('HMSET', key, 'count', count, 'reset_at', reset_at)
-            redis.call('EXPIRE', key, 86400) -- 24h TTL
-            
-            return {1, count, limit} -- success
-        """
-        
         try:
             key = f"usage:{user_id}:{feature_name}"
-            result = await self.client.eval(
-                lua_script, 
-                1, 
-                key, 
-                limit, 
-                delta, 
-                reset_at or "",
-                time.time()
+            result = await self._atomic_usage(
+                keys=[key, USAGE_DIRTY_KEY, f"usage:user:{user_id}:features"],
+                args=[limit, delta, reset_at or "", time.time(), f"{user_id}:{feature_name}", feature_name]
             )
             
             return {
@@ -168,6 +284,80 @@ class RedisClient:
             logger.error(f"Failed atomic usage check: {e}")
             raise
     
+    async def _drain_list(self, key: str, count: int) -> List[str]:
+        """Pop up to `count` entries from the head of a list in one MULTI."""
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.lrange(key, 0, count - 1)
+            pipe.ltrim(key, count, -1)
+            entries, _ = await pipe.execute()
+            return entries
+        except Exception as e:
+            logger.error(f"Failed to drain {key}: {e}")
+            return []
+    
+    async def drain_usage_dirty(self, count: int) -> List[str]:
+        """Pop up to `count` entries from the head of the usage dirty list."""
+        return await self._drain_list(USAGE_DIRTY_KEY, count)
+    
+    async def push_subscription_events(self, events: List[Dict[str, Any]]):
+        """Append subscription events to the outbox list."""
+        try:
+            await self.client.rpush(SUBSCRIPTION_EVENTS_KEY, *[dump_message(event) for event in events])
+        except Exception as e:
+            logger.error(f"Failed to push {len(events)} subscription events: {e}")
+    
+    async def drain_subscription_events(self, count: int) -> List[str]:
+        """Pop up to `count` serialized events from the head of the outbox list."""
+        return await self._drain_list(SUBSCRIPTION_EVENTS_KEY, count)
+    
+    async def requeue_subscription_events(self, entries: List[str]):
+        """Put drained events back at the head, in order, so the next flush retries them."""
+        try:
+            await self.client.lpush(SUBSCRIPTION_EVENTS_KEY, *reversed(entries))
+        except Exception as e:
+            logger.error(f"Failed to requeue {len(entries)} subscription events: {e}")
+    
+    async def requeue_usage_dirty(self, entries: List[str]):
+        """Put drained usage entries back at the head, in order, so the next sync retries them."""
+        try:
+            await self.client.lpush(USAGE_DIRTY_KEY, *reversed(entries))
+        except Exception as e:
+            logger.error(f"Failed to requeue {len(entries)} entries to {USAGE_DIRTY_KEY}: {e}")
+    
+    async def reset_usage_counters(self, pairs: Sequence[Tuple[int, str]], batch_size: int = 500) -> int:
+        """
+        Drop usage:{user_id}:{feature_name} hashes and queue a zero count for each.
+        
+        The zero entries go through the same MULTI as the UNLINK, so counts
+        still waiting in the dirty list cannot resurrect the reset value.
+        """
+        try:
+            cleared = 0
+            for start in range(0, len(pairs), batch_size):
+                batch = pairs[start:start + batch_size]
+                pipe = self.client.pipeline(transaction=True)
+                pipe.unlink(*[f"usage:{user_id}:{feature_name}" for user_id, feature_name in batch])
+                pipe.rpush(USAGE_DIRTY_KEY, *[f"{user_id}:{feature_name}:0" for user_id, feature_name in batch])
+                unlinked, _ = await pipe.execute()
+                cleared += unlinked
+            return cleared
+        except Exception as e:
+            logger.error(f"Failed to reset usage counters: {e}")
+            return 0
+    
+    async def reset_user_usage_counters(self, user_id: int) -> int:
+        """Reset every usage counter of one user, found via the user's feature set."""
+        features_key = f"usage:user:{user_id}:features"
+        try:
+            feature_names = await self.client.smembers(features_key)
+            cleared = await self.reset_usage_counters([(user_id, name) for name in feature_names])
+            await self.client.unlink(features_key)
+            return cleared
+        except Exception as e:
+            logger.error(f"Failed to reset usage counters for user {user_id}: {e}")
+            return 0
+    
     async def set_lock(self, lock_key: str, ttl_seconds: int = 300) -> bool:
         """
         Set a distributed lock.
@@ -187,6 +377,32 @@ class RedisClient:
         except Exception as e:
             logger.error(f"Failed to release lock {lock_key}: {e}")
     
+    async def get_active_sub(self, user_id: int) -> Dict[str, str]:
+        """Get a user's cached active-subscription summary (empty dict on miss)."""
+        try:
+            return await self.client.hgetall(f"user:{user_id}:active_sub")
+        except Exception as e:
+            logger.error(f"Failed to read active subscription cache for user {user_id}: {e}")
+            return {}
+    
+    async def set_active_sub(self, user_id: int, summary: Dict[str, str], ttl_seconds: int):
+        """Cache a user's active-subscription summary as a hash with a TTL."""
+        key = f"user:{user_id}:active_sub"
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.hset(key, mapping=summary)
+            pipe.expire(key, ttl_seconds)
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to cache active subscription for user {user_id}: {e}")
+    
+    async def invalidate_active_sub(self, user_id: int):
+        """Drop a user's cached active-subscription summary."""
+        try:
+            await self.client.delete(f"user:{user_id}:active_sub")
+        except Exception as e:
+            logger.error(f"Failed to invalidate active subscription cache for user {user_id}: {e}")
+    
     async def get_queue_length(self, queue_name: str) -> int:
         """Get length of a queue."""
         try:
@@ -2,13 +2,14 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer
 import logging
 
 from app.core.config import settings
 from app.core.logging import setup_logging
 from app.core.redis_client import redis_client
+from app.core.database import db_manager, start_query_count
 from app.api.v1.router import api_router
 
 
@@ -23,6 +24,10 @@ async def lifespan(app: FastAPI):
     # Startup
     try:
         await redis_client.connect()
+        if settings.DATABASE_POOL_WARM_ON_STARTUP:
+            await db_manager.warm_pool()
+        # Build the OpenAPI schema once so the first /docs request doesn't pay for it
+        app.openapi()
         logger.info("Subscription Service startup completed")
     except Exception as e:
         logger.error(f"Subscription Service startup failed: {e}")
@@ -33,6 +38,7 @@ async def lifespan(app: FastAPI):
     # Shutdown
     try:
         await redis_client.disconnect()
+        await db_manager.close_connections()
         logger.info("Subscription Service shutdown completed")
     except Exception as e:
         logger.error(f"Subscription Service shutdown failed: {e}")
@@ -73,6 +79,7 @@ app = FastAPI(
     redoc_url="/redoc",
     openapi_url="/openapi.json",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     # Configure security for Swagger UI
     swagger_ui_parameters={
         "persistAuthorization": True,
@@ -94,22 +101,32 @@ app.openapi_components = {
 # Set global security requirement
 app.openapi_security = [{"BearerAuth": []}]
 
-# Add CORS middleware
+# Add CORS middleware (credentials are only allowed with an explicit origin list)
+allowed_origins = settings.CORS_ALLOWED_ORIGINS or ["*"]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure appropriately for production
-    allow_credentials=True,
+    allow_origins=allowed_origins,
+    allow_credentials=(allowed_origins != ["*"]),
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-# Add trusted host middleware for production
-if settings.ENVIRONMENT == "production":
+# Add trusted host middleware only when hosts are restricted; a wildcard is a no-op
+if settings.TRUSTED_HOSTS and settings.TRUSTED_HOSTS != ["*"]:
     app.add_middleware(
         TrustedHostMiddleware,
-        allowed_hosts=["*"]  # Configure appropriately for production
+        allowed_hosts=settings.TRUSTED_HOSTS
     )
 
+# Expose the number of database queries per request while debugging to catch N+1 regressions
+if settings.DEBUG:
+    @app.middleware("http")
+    async def count_db_queries(request: Request, call_next):
+        counter = start_query_count()
+        response = await call_next(request)
+        response.headers["X-DB-Queries"] = str(counter[0])
+        return response
+
 # Include API router
 app.include_router(api_router, prefix="/v1")
 
@@ -143,7 +160,7 @@ async def root():
 async def global_exception_handler(request: Request, exc: Exception):
     """Global exception handler."""
     logger.error(f"Unhandled exception: {exc}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "success": False,
@@ -156,7 +173,7 @@ async def global_exception_handler(request: Request, exc: Exception):
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     """HTTP exception handler."""
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={
             "success": False,
@@ -166,6 +183,10 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     )
 
 
+# Paths that don't require the BearerAuth security requirement
+SKIP_PREFIXES = ("/v1/auth/", "/v1/health")
+
+
 # Override OpenAPI schema to include security
 def custom_openapi():
     if app.openapi_schema:
@@ -193,7 +214,7 @@ def custom_openapi():
     # Add security requirement to protected endpoints
     for path, path_item in openapi_schema["paths"].items():
         # Skip auth endpoints and health checks
-        if "/auth/" in path or "/health" in path:
+        if path.startswith(SKIP_PREFIXES):
             continue
         
         for method, operation in path_item.items():
@@ -213,5 +234,8 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8000,
         reload=settings.DEBUG,
-        log_level=settings.LOG_LEVEL.lower()
+        log_level=settings.LOG_LEVEL.lower(),
+        loop="uvloop",
+        http="httptools",
+        workers=settings.UVICORN_WORKERS
     ) 
\ No newline at end of file
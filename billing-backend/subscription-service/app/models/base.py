@@ -1,11 +1,14 @@
 from datetime import datetime
-from typing import Any
-from sqlalchemy import Column, DateTime, func
+from typing import Any, Dict, Tuple
+from sqlalchemy import Column, DateTime, func, inspect
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import Mapped
 
 from app.core.database import Base
 
+# Per-class cache of column attribute names
+_COLUMN_NAMES: Dict[type, Tuple[str, ...]] = {}
+
 
 class TimestampMixin:
     """Mixin for adding timestamp fields to models."""
@@ -29,9 +32,18 @@ class BaseModel(Base, TimestampMixin):
     
     __abstract__ = True
     
+    @classmethod
+    def _column_names(cls) -> Tuple[str, ...]:
+        """Get mapped column attribute names, computed once per class."""
+        names = _COLUMN_NAMES.get(cls)
+        if names is None:
+            names = tuple(attr.key for attr in inspect(cls).column_attrs)
+            _COLUMN_NAMES[cls] = names
+        return names
+    
     def to_dict(self) -> dict[str, Any]:
         """Convert model instance to dictionary."""
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return {name: getattr(self, name) for name in self._column_names()}
     
     def update_from_dict(self, data: dict[str, Any]) -> None:
         """Update model instance from dictionary."""
@@ -15,6 +15,8 @@ class PaymentWebhookRequest(Base):
     id: Mapped[int] = Column(Integer, primary_key=True, index=True)
     event_id: Mapped[str] = Column(String(255), unique=True, nullable=False, index=True)
     payload: Mapped[Dict[str, Any]] = Column(JSONB, nullable=False)
+    # Hash of the fields a webhook acts on, so a replay under a new event_id is still a duplicate
+    content_hash: Mapped[Optional[str]] = Column(String(32), unique=True, nullable=True)
     processed: Mapped[bool] = Column(Boolean, default=False, nullable=False, index=True)
     processed_at: Mapped[Optional[datetime]] = Column(DateTime(timezone=True), nullable=True)
     error_message: Mapped[Optional[str]] = Column(Text, nullable=True)
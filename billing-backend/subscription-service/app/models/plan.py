@@ -79,6 +79,7 @@ class Plan(BaseModel):
     
     def get_feature_limits(self) -> Dict[str, int]:
         """Get all feature limits for this plan."""
+        # features is JSONB, already decoded by the driver; this is a plain dict lookup
         return self.features.get("limits", {})
     
     def has_feature(self, feature_name: str) -> bool:
@@ -1,8 +1,10 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, select, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship, Mapped
 from typing import List, Optional
 
 from .base import BaseModel
+from .subscription import Subscription
 
 
 class User(BaseModel):
@@ -38,9 +40,29 @@ class User(BaseModel):
             return f"{self.first_name} {self.last_name}"
         return self.first_name or self.last_name or self.email
     
+    @classmethod
+    async def get_active(cls, session: AsyncSession, user_id: int) -> Optional["Subscription"]:
+        """Get a user's active subscription with a single indexed query."""
+        query = (
+            select(Subscription)
+            .where(
+                Subscription.user_id == user_id,
+                Subscription.status.in_(("active", "trial"))
+            )
+            .limit(1)
+        )
+        return await session.scalar(query)
+    
     @property
-    def active_subscription(self) -> "Subscription":
-        """Get user's active subscription."""
+    def active_subscription(self) -> Optional["Subscription"]:
+        """
+        Get user's active subscription from the already-loaded collection.
+        
+        Returns None when ``subscriptions`` has not been loaded; use
+        ``User.get_active`` to query it instead of triggering a lazy load.
+        """
+        if "subscriptions" in inspect(self).unloaded:
+            return None
         for subscription in self.subscriptions:
             if subscription.status in ["active", "trial"]:
                 return subscription
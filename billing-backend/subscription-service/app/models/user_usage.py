@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship, Mapped
 from typing import Optional
 
@@ -11,12 +11,12 @@ class UserUsage(BaseModel):
     
     __tablename__ = "user_usage"
     __table_args__ = (
-        UniqueConstraint('user_id', 'feature_name', name='_user_feature_uc'),
+        Index('ix_user_usage_user_feature', 'user_id', 'feature_name', unique=True),
     )
     
     id: Mapped[int] = Column(Integer, primary_key=True, index=True)
-    user_id: Mapped[int] = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
-    feature_name: Mapped[str] = Column(String(50), nullable=False, index=True)
+    user_id: Mapped[int] = Column(Integer, ForeignKey("users.id"), nullable=False)
+    feature_name: Mapped[str] = Column(String(50), nullable=False)
     usage_count: Mapped[int] = Column(Integer, default=0, nullable=False)
     reset_at: Mapped[datetime] = Column(DateTime(timezone=True), nullable=False)
     
@@ -1,39 +1,90 @@
-from typing import Optional, List
+from copy import deepcopy
+from typing import Optional, List, Any, Dict
+from cachetools import TTLCache
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, cast, case, Integer
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import aliased, make_transient_to_detached
 
 from app.models.plan import Plan
 from .base_repository import BaseRepository
 
 
+def renewal_plan_id_expr(trial_plan) -> Any:
+    """SQL expression for a trial plan's features->>'renewal_plan' as an integer plan ID."""
+    renewal_ref = trial_plan.features["renewal_plan"].astext
+    # Only cast numeric references so malformed metadata yields no row instead of an error
+    return case((renewal_ref.op("~")("^[0-9]+$"), cast(renewal_ref, Integer)))
+
+
 class PlanRepository(BaseRepository[Plan]):
     """Repository for Plan operations."""
     
+    # Plans are near-static reference data, so column snapshots are shared
+    # across sessions for a short TTL and cleared on any local write
+    _cache: TTLCache = TTLCache(maxsize=256, ttl=60)
+    
     def __init__(self, session: AsyncSession):
         super().__init__(Plan, session)
     
+    async def _attach(self, data: Dict[str, Any]) -> Plan:
+        """Rebuild a cached plan snapshot as an instance of this session without a SELECT."""
+        # Copy so in-place edits to JSONB features never leak into the shared cache
+        plan = Plan(**deepcopy(data))
+        make_transient_to_detached(plan)
+        return await self.session.merge(plan, load=False)
+    
+    async def get_by_id(self, id: Any, relationships: List[str] = None) -> Optional[Plan]:
+        """Get a plan by ID, served from the shared cache when no relationships are requested."""
+        if relationships:
+            return await super().get_by_id(id, relationships)
+        
+        cached = self._cache.get(("id", id))
+        if cached is not None:
+            return await self._attach(cached)
+        
+        plan = await super().get_by_id(id)
+        if plan is not None:
+            self._cache[("id", id)] = plan.to_dict()
+        return plan
+    
     async def get_active_plans(self) -> List[Plan]:
         """Get all active plans."""
-        return await self.get_all(filters={"is_active": True})
+        cached = self._cache.get(("active",))
+        if cached is not None:
+            return [await self._attach(data) for data in cached]
+        
+        plans = await self.get_all(filters={"is_active": True})
+        self._cache[("active",)] = [plan.to_dict() for plan in plans]
+        return plans
+    
+    async def create(self, obj_data: Dict[str, Any]) -> Plan:
+        """Create a plan and invalidate the plan cache."""
+        self._cache.clear()
+        return await super().create(obj_data)
+    
+    async def update(self, id: Any, obj_data: Dict[str, Any]) -> Optional[Plan]:
+        """Update a plan and invalidate the plan cache."""
+        self._cache.clear()
+        return await super().update(id, obj_data)
+    
+    async def delete(self, id: Any) -> bool:
+        """Delete a plan and invalidate the plan cache."""
+        self._cache.clear()
+        return await super().delete(id)
     
     async def get_trial_plans(self) -> List[Plan]:
         """Get all trial plans based on features metadata."""
         try:
-            # Query for plans where features contains trial key
-            # This supports both {"trial": true} and {"trial": {...}} formats
+            # Containment on {"trial": true} matches Plan.is_trial_plan exactly
+            # and is served by the partial jsonb_path_ops GIN index
             query = select(Plan).where(
                 Plan.is_active == True,
-                Plan.features.op("?")('"trial"')  # JSONB contains key "trial"
+                Plan.features.op("@>")(cast({"trial": True}, JSONB))
             )
             
             result = await self.session.execute(query)
-            plans = result.scalars().all()
-            
-            # Additional filtering using the model's is_trial_plan property
-            # to ensure consistency with metadata-based detection
-            trial_plans = [plan for plan in plans if plan.is_trial_plan]
-            
-            return trial_plans
+            return list(result.scalars().all())
         except Exception as e:
             self.logger.error(f"Error getting trial plans: {e}")
             raise
@@ -51,22 +102,20 @@ class PlanRepository(BaseRepository[Plan]):
         Uses simplified metadata format where renewal_plan is directly the plan ID.
         """
         try:
-            trial_plan = await self.get_by_id(trial_plan_id)
-            if not trial_plan or not trial_plan.is_trial_plan:
-                return None
-            
-            # Use the plan's property which now handles the simplified format
-            renewal_plan_id = trial_plan.trial_renewal_plan_id
+            # Resolve trial plan -> renewal plan in one statement by joining plans to itself
+            trial_plan = aliased(Plan)
             
-            # Try integer lookup
-            if renewal_plan_id:
-                try:
-                    return await self.get_by_id(int(renewal_plan_id))
-                except Exception:
-                    # Invalid integer format, skip
-                    pass
+            query = (
+                select(Plan)
+                .join(trial_plan, Plan.id == renewal_plan_id_expr(trial_plan))
+                .where(
+                    trial_plan.id == trial_plan_id,
+                    trial_plan.features.op("@>")(cast({"trial": True}, JSONB))
+                )
+            )
             
-            return None
+            result = await self.session.execute(query)
+            return result.scalars().first()
         except Exception as e:
             self.logger.error(f"Error getting renewal plan for trial {trial_plan_id}: {e}")
-            raise 
\ No newline at end of file
+            raise
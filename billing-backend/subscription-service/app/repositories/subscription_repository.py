@@ -1,12 +1,64 @@
-from datetime import datetime
-from typing import Optional, List
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Optional, List, Tuple, Dict, Any
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, or_
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, insert, update, and_, union_all, func, bindparam, cast
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import selectinload, raiseload, aliased
 from uuid import UUID
 
+from app.models.plan import Plan
 from app.models.subscription import Subscription
+from app.models.subscription_event import SubscriptionEvent
 from .base_repository import BaseRepository
+from .plan_repository import renewal_plan_id_expr
+
+# Hot-path statements built once; SQLAlchemy memoizes their cache keys
+_OPEN_STATES_STMT = (
+    select(
+        Subscription.status,
+        (Subscription.end_date > func.now()).label("is_current")
+    )
+    .where(
+        and_(
+            Subscription.user_id == bindparam("user_id"),
+            Subscription.status.in_(["active", "trial", "pending"])
+        )
+    )
+)
+
+_ACTIVE_SUMMARY_STMT = (
+    select(
+        Subscription.id,
+        Subscription.plan_id,
+        Subscription.status,
+        Subscription.end_date,
+        Plan.features["limits"].label("limits")
+    )
+    .join(Plan, Plan.id == Subscription.plan_id)
+    .where(
+        and_(
+            Subscription.user_id == bindparam("user_id"),
+            Subscription.status.in_(["active", "trial", "pending"]),
+            Subscription.end_date > func.now()
+        )
+    )
+    .order_by(Subscription.start_date.desc())
+    .limit(1)
+)
+
+_ACTIVE_BY_USER_STMT = (
+    select(Subscription)
+    .where(
+        and_(
+            Subscription.user_id == bindparam("user_id"),
+            Subscription.status.in_(["active", "trial", "pending"]),
+            Subscription.end_date > func.now()
+        )
+    )
+    .options(selectinload(Subscription.plan), raiseload('*'))
+    .order_by(Subscription.start_date.desc())
+)
 
 
 class SubscriptionRepository(BaseRepository[Subscription]):
@@ -21,7 +73,7 @@ class SubscriptionRepository(BaseRepository[Subscription]):
             query = (
                 select(Subscription)
                 .where(Subscription.user_id == user_id)
-                .options(selectinload(Subscription.plan))
+                .options(selectinload(Subscription.plan), raiseload('*'))
                 .order_by(Subscription.start_date.desc())
             )
             result = await self.session.execute(query)
@@ -30,28 +82,44 @@ class SubscriptionRepository(BaseRepository[Subscription]):
             self.logger.error(f"Error getting subscriptions for user {user_id}: {e}")
             raise
     
+    async def get_open_subscription_states(self, user_id: int) -> List[Tuple[str, bool]]:
+        """
+        Get (status, is_current) for a user's active, trial or pending subscriptions.
+        
+        is_current is end_date > now(); pending rows are returned even once
+        past their end date, so callers can check both in one query.
+        """
+        try:
+            result = await self.session.execute(_OPEN_STATES_STMT, {"user_id": user_id})
+            return [(status, bool(is_current)) for status, is_current in result.all()]
+        except Exception as e:
+            self.logger.error(f"Error getting open subscriptions for user {user_id}: {e}")
+            raise
+    
     async def get_active_subscription_by_user(self, user_id: int) -> Optional[Subscription]:
         """Get active subscription for a user."""
         try:
-            query = (
-                select(Subscription)
-                .where(
-                    and_(
-                        Subscription.user_id == user_id,
-                        Subscription.status.in_(["active", "trial", "pending"]),
-                        Subscription.end_date > datetime.utcnow()
-                    )
-                )
-                .options(selectinload(Subscription.plan))
-                .order_by(Subscription.start_date.desc())
-            )
-            
-            result = await self.session.execute(query)
+            result = await self.session.execute(_ACTIVE_BY_USER_STMT, {"user_id": user_id})
             return result.scalars().first()
         except Exception as e:
             self.logger.error(f"Error getting active subscription for user {user_id}: {e}")
             raise
     
+    async def get_active_subscription_summary(self, user_id: int) -> Optional[Tuple[UUID, int, str, datetime, Dict[str, int]]]:
+        """
+        Get (subscription_id, plan_id, status, end_date, plan limits) of a user's active subscription.
+        
+        Same selection as get_active_subscription_by_user, but one joined
+        query returning plain columns instead of Subscription and Plan objects.
+        """
+        try:
+            result = await self.session.execute(_ACTIVE_SUMMARY_STMT, {"user_id": user_id})
+            row = result.first()
+            return (row.id, row.plan_id, row.status, row.end_date, row.limits or {}) if row else None
+        except Exception as e:
+            self.logger.error(f"Error getting active subscription summary for user {user_id}: {e}")
+            raise
+    
     async def get_with_relationships(self, subscription_id: UUID) -> Optional[Subscription]:
         """Get subscription with user and plan relationships."""
         return await self.get_by_id(
@@ -59,16 +127,62 @@ class SubscriptionRepository(BaseRepository[Subscription]):
             relationships=["user", "plan", "events"]
         )
     
+    async def switch_to_renewal_plan(
+        self,
+        subscription_id: UUID,
+        **values: Any
+    ) -> Optional[Tuple[int, Decimal, str]]:
+        """
+        Move a subscription from its trial plan to the configured renewal plan.
+        
+        One UPDATE ... FROM resolves the renewal plan and switches to it (also
+        writing any extra column ``values`` given, e.g. status or end_date),
+        returning (plan_id, price, name); None when the current plan has no
+        renewal plan, in which case nothing is written.
+        """
+        try:
+            trial_plan = aliased(Plan)
+            renewal_plan = aliased(Plan)
+            
+            stmt = (
+                update(Subscription)
+                .where(
+                    Subscription.id == subscription_id,
+                    trial_plan.id == Subscription.plan_id,
+                    trial_plan.features.op("@>")(cast({"trial": True}, JSONB)),
+                    renewal_plan.id == renewal_plan_id_expr(trial_plan)
+                )
+                .values(plan_id=renewal_plan.id, **values)
+                .returning(renewal_plan.id, renewal_plan.price, renewal_plan.name)
+                .execution_options(synchronize_session=False)
+            )
+            
+            result = await self.session.execute(stmt)
+            row = result.first()
+            return (row[0], row[1], row[2]) if row else None
+        except Exception as e:
+            self.logger.error(f"Error switching subscription {subscription_id} to renewal plan: {e}")
+            raise
+    
+    async def bulk_insert_events(self, rows: List[Dict[str, Any]]) -> int:
+        """Insert subscription event rows (attribute-keyed dicts) as one executemany."""
+        if not rows:
+            return 0
+        
+        try:
+            await self.session.execute(insert(SubscriptionEvent), rows)
+            return len(rows)
+        except Exception as e:
+            self.logger.error(f"Error inserting {len(rows)} subscription events: {e}")
+            await self.session.rollback()
+            raise
+    
     async def get_expiring_subscriptions(self, days_ahead: int = 3) -> List[Subscription]:
         """Get subscriptions expiring within specified days."""
         try:
-            expiry_date = datetime.utcnow().replace(hour=23, minute=59, second=59)
-            future_date = datetime.utcnow().replace(
-                day=datetime.utcnow().day + days_ahead,
-                hour=23, 
-                minute=59, 
-                second=59
-            )
+            # Window bounds are computed by the database: end of today (UTC) up to days_ahead later
+            expiry_date = func.date_trunc("day", func.now(), "UTC") + timedelta(days=1, seconds=-1)
+            future_date = expiry_date + timedelta(days=days_ahead)
             
             query = (
                 select(Subscription)
@@ -79,7 +193,7 @@ class SubscriptionRepository(BaseRepository[Subscription]):
                         Subscription.end_date <= future_date
                     )
                 )
-                .options(selectinload(Subscription.user), selectinload(Subscription.plan))
+                .options(selectinload(Subscription.user), selectinload(Subscription.plan), raiseload('*'))
             )
             
             result = await self.session.execute(query)
@@ -91,18 +205,19 @@ class SubscriptionRepository(BaseRepository[Subscription]):
     async def get_past_due_subscriptions(self) -> List[Subscription]:
         """Get subscriptions that are past due."""
         try:
+            # Two disjoint branches, each served by its own partial index
+            past_due = select(Subscription).where(Subscription.status == "past_due")
+            lapsed = select(Subscription).where(
+                and_(
+                    Subscription.status.in_(["active", "trial"]),
+                    Subscription.end_date < func.now()
+                )
+            )
+            
             query = (
                 select(Subscription)
-                .where(
-                    or_(
-                        Subscription.status == "past_due",
-                        and_(
-                            Subscription.status.in_(["active", "trial"]),
-                            Subscription.end_date < datetime.utcnow()
-                        )
-                    )
-                )
-                .options(selectinload(Subscription.user), selectinload(Subscription.plan))
+                .from_statement(union_all(past_due, lapsed))
+                .options(selectinload(Subscription.user), selectinload(Subscription.plan), raiseload('*'))
             )
             
             result = await self.session.execute(query)
@@ -122,7 +237,7 @@ class SubscriptionRepository(BaseRepository[Subscription]):
         """Update subscription status."""
         update_data = {"status": status}
         if status == "cancelled":
-            update_data["canceled_at"] = datetime.utcnow()
+            update_data["canceled_at"] = func.now()
         
         return await self.update(subscription_id, update_data)
     
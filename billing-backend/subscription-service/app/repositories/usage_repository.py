@@ -1,7 +1,7 @@
-from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Dict, Any, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, update
+from sqlalchemy import select, and_, update, func
 from sqlalchemy.dialects.postgresql import insert
 
 from app.models.user_usage import UserUsage
@@ -22,7 +22,7 @@ class UsageRepository(BaseRepository[UserUsage]):
                     UserUsage.user_id == user_id,
                     UserUsage.feature_name == feature_name
                 )
-            )
+            ).limit(1)
             
             result = await self.session.execute(query)
             return result.scalars().first()
@@ -61,23 +61,98 @@ class UsageRepository(BaseRepository[UserUsage]):
                 set_=dict(
                     usage_count=stmt.excluded.usage_count,
                     reset_at=stmt.excluded.reset_at,
-                    updated_at=datetime.utcnow()
+                    updated_at=func.now()
                 )
+            ).returning(UserUsage)
+            
+            # Hydrate the written row from RETURNING instead of re-selecting it
+            query = select(UserUsage).from_statement(stmt).execution_options(populate_existing=True)
+            result = await self.session.execute(query)
+            return result.scalar_one()
+            
+        except Exception as e:
+            self.logger.error(f"Error upserting usage for user {user_id}, feature {feature_name}: {e}")
+            await self.session.rollback()
+            raise
+    
+    async def increment_usage_atomic(
+        self,
+        user_id: int,
+        feature_name: str,
+        delta: int,
+        reset_at: datetime
+    ) -> UserUsage:
+        """Add delta to a usage counter in a single INSERT ... ON CONFLICT statement."""
+        try:
+            stmt = insert(UserUsage).values(
+                user_id=user_id,
+                feature_name=feature_name,
+                usage_count=delta,
+                reset_at=reset_at
             )
             
-            await self.session.execute(stmt)
-            await self.session.flush()
+            # On conflict, add the proposed delta to the stored counter in the database
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'feature_name'],
+                set_=dict(
+                    usage_count=UserUsage.__table__.c.usage_count + stmt.excluded.usage_count,
+                    updated_at=func.now()
+                )
+            ).returning(UserUsage)
             
-            # Return the updated record
-            return await self.get_user_feature_usage(user_id, feature_name)
+            query = select(UserUsage).from_statement(stmt).execution_options(populate_existing=True)
+            result = await self.session.execute(query)
+            return result.scalar_one()
             
         except Exception as e:
-            self.logger.error(f"Error upserting usage for user {user_id}, feature {feature_name}: {e}")
+            self.logger.error(f"Error incrementing usage for user {user_id}, feature {feature_name}: {e}")
+            await self.session.rollback()
+            raise
+    
+    async def bulk_upsert_usage(self, rows: List[Tuple[int, str, int, datetime]]) -> int:
+        """
+        Upsert absolute (user_id, feature_name, usage_count, reset_at) rows.
+        
+        Runs one fixed INSERT ... ON CONFLICT statement as an executemany, so
+        the prepared statement is reused whatever the batch size.
+        """
+        if not rows:
+            return 0
+        
+        try:
+            stmt = insert(UserUsage)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'feature_name'],
+                set_=dict(
+                    usage_count=stmt.excluded.usage_count,
+                    reset_at=stmt.excluded.reset_at,
+                    updated_at=func.now()
+                )
+            )
+            await self.session.execute(stmt, [
+                {
+                    "user_id": user_id,
+                    "feature_name": feature_name,
+                    "usage_count": usage_count,
+                    "reset_at": reset_at
+                }
+                for user_id, feature_name, usage_count, reset_at in rows
+            ])
+            return len(rows)
+        except Exception as e:
+            self.logger.error(f"Error bulk upserting {len(rows)} usage records: {e}")
             await self.session.rollback()
             raise
     
     async def reset_all_user_usage(self, user_id: int) -> int:
         """Reset all usage records for a specific user."""
+        return await self.reset_usage_for_users([user_id])
+    
+    async def reset_usage_for_users(self, user_ids: List[int]) -> int:
+        """Reset all usage records for a batch of users in a single UPDATE."""
+        if not user_ids:
+            return 0
+        
         try:
             # Calculate next month first day
             now = datetime.utcnow()
@@ -85,71 +160,89 @@ class UsageRepository(BaseRepository[UserUsage]):
             
             stmt = (
                 update(UserUsage)
-                .where(UserUsage.user_id == user_id)
-                .values(usage_count=0, reset_at=next_month_first, updated_at=datetime.utcnow())
+                .where(UserUsage.user_id.in_(user_ids))
+                .values(usage_count=0, reset_at=next_month_first, updated_at=func.now())
             )
             result = await self.session.execute(stmt)
             await self.session.flush()
             return result.rowcount or 0
         except Exception as e:
-            self.logger.error(f"Error resetting all usage for user {user_id}: {e}")
+            self.logger.error(f"Error resetting usage for {len(user_ids)} users: {e}")
             await self.session.rollback()
             raise
     
-    async def reset_expired_usage(self) -> int:
-        """Reset usage for expired records."""
+    async def reset_expired_usage(self) -> List[Tuple[int, str]]:
+        """Reset usage for expired records, returning the (user_id, feature_name) pairs reset."""
         try:
-            # Get all expired records
-            all_records = await self.get_all()
-            expired_records = [r for r in all_records if r.is_expired]
+            # Calculate new reset time (first day of next month)
+            new_reset_at = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            if new_reset_at.month == 12:
+                new_reset_at = new_reset_at.replace(year=new_reset_at.year + 1, month=1)
+            else:
+                new_reset_at = new_reset_at.replace(month=new_reset_at.month + 1)
             
-            reset_count = 0
-            for record in expired_records:
-                # Calculate new reset time (next month)
-                new_reset_at = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                if new_reset_at.month == 12:
-                    new_reset_at = new_reset_at.replace(year=new_reset_at.year + 1, month=1)
-                else:
-                    new_reset_at = new_reset_at.replace(month=new_reset_at.month + 1)
-                
-                await self.update(record.id, {
-                    "usage_count": 0,
-                    "reset_at": new_reset_at
-                })
-                reset_count += 1
-            
-            return reset_count
+            stmt = (
+                update(UserUsage)
+                .where(UserUsage.reset_at <= func.now())
+                .values(usage_count=0, reset_at=new_reset_at, updated_at=func.now())
+                .returning(UserUsage.user_id, UserUsage.feature_name)
+            )
+            result = await self.session.execute(stmt)
+            await self.session.flush()
+            return [tuple(row) for row in result.all()]
             
         except Exception as e:
             self.logger.error(f"Error resetting expired usage: {e}")
+            await self.session.rollback()
+            raise
+    
+    async def get_user_usage_aggregate(self, user_id: int) -> Tuple[int, int, Optional[datetime]]:
+        """Get (total_usage, feature_count, last_updated) for a user in one query."""
+        try:
+            query = select(
+                func.coalesce(func.sum(UserUsage.usage_count), 0),
+                func.count(),
+                func.max(UserUsage.updated_at)
+            ).where(UserUsage.user_id == user_id)
+            
+            result = await self.session.execute(query)
+            total_usage, feature_count, last_updated = result.one()
+            return int(total_usage), feature_count, last_updated
+        except Exception as e:
+            self.logger.error(f"Error getting usage aggregate for user {user_id}: {e}")
             raise
     
     async def get_usage_stats(self, user_id: int) -> Dict[str, Any]:
         """Get usage statistics for a user."""
         try:
-            usage_records = await self.get_user_all_usage(user_id)
+            total_usage, feature_count, last_updated = await self.get_user_usage_aggregate(user_id)
             
-            total_usage = sum(record.usage_count for record in usage_records)
+            # Plain row tuples are enough for the breakdown; no ORM hydration needed
+            query = select(
+                UserUsage.feature_name,
+                UserUsage.usage_count,
+                UserUsage.reset_at
+            ).where(UserUsage.user_id == user_id)
+            result = await self.session.execute(query)
+            
+            now = datetime.now(timezone.utc)
             feature_breakdown = {
-                record.feature_name: {
-                    "usage_count": record.usage_count,
-                    "reset_at": record.reset_at,
-                    "is_expired": record.is_expired
+                feature_name: {
+                    "usage_count": usage_count,
+                    "reset_at": reset_at,
+                    "is_expired": reset_at <= now
                 }
-                for record in usage_records
+                for feature_name, usage_count, reset_at in result.all()
             }
             
             return {
                 "user_id": user_id,
                 "total_usage": total_usage,
-                "feature_count": len(usage_records),
+                "feature_count": feature_count,
                 "features": feature_breakdown,
-                "last_updated": max(
-                    (record.updated_at for record in usage_records), 
-                    default=None
-                )
+                "last_updated": last_updated
             }
             
         except Exception as e:
             self.logger.error(f"Error getting usage stats for user {user_id}: {e}")
-            raise 
\ No newline at end of file
+            raise
\ No newline at end of file
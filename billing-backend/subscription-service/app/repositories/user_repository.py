@@ -1,7 +1,7 @@
-from typing import Optional, List
+from typing import Optional, Dict, Any, AsyncIterator
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, raiseload
 
 from app.models.user import User
 from .base_repository import BaseRepository
@@ -12,10 +12,34 @@ class UserRepository(BaseRepository[User]):
     
     def __init__(self, session: AsyncSession):
         super().__init__(User, session)
+        # Sessions are request-scoped, so this cache lives for one request
+        self._email_cache: Dict[str, User] = {}
     
     async def get_by_email(self, email: str) -> Optional[User]:
-        """Get user by email address."""
-        return await self.get_by_field("email", email)
+        """Get user by email address, cached for the lifetime of the session."""
+        cached = self._email_cache.get(email)
+        if cached is not None:
+            return cached
+        
+        user = await self.get_by_field("email", email)
+        if user is not None:
+            self._email_cache[email] = user
+        return user
+    
+    async def create(self, obj_data: Dict[str, Any]) -> User:
+        """Create a user and drop any cached email lookups."""
+        self._email_cache.clear()
+        return await super().create(obj_data)
+    
+    async def update(self, id: Any, obj_data: Dict[str, Any]) -> Optional[User]:
+        """Update a user and drop any cached email lookups."""
+        self._email_cache.clear()
+        return await super().update(id, obj_data)
+    
+    async def delete(self, id: Any) -> bool:
+        """Delete a user and drop any cached email lookups."""
+        self._email_cache.clear()
+        return await super().delete(id)
     
     async def get_with_subscriptions(self, user_id: int) -> Optional[User]:
         """Get user with their subscriptions."""
@@ -25,18 +49,20 @@ class UserRepository(BaseRepository[User]):
         """Get user with their usage records."""
         return await self.get_by_id(user_id, relationships=["usage_records"])
     
-    async def get_users_with_active_subscriptions(self) -> List[User]:
-        """Get all users with active subscriptions."""
+    async def get_users_with_active_subscriptions(self, batch_size: int = 500) -> AsyncIterator[User]:
+        """Stream users with active subscriptions in batches of ``batch_size``."""
         try:
+            # EXISTS via any() yields each user once, so no join or unique() pass is needed
             query = (
                 select(User)
-                .join(User.subscriptions)
                 .where(User.subscriptions.any(status="active"))
-                .options(selectinload(User.subscriptions))
+                .options(selectinload(User.subscriptions), raiseload('*'))
+                .execution_options(yield_per=batch_size)
             )
             
-            result = await self.session.execute(query)
-            return result.scalars().unique().all()
+            result = await self.session.stream_scalars(query)
+            async for user in result:
+                yield user
         except Exception as e:
             self.logger.error(f"Error getting users with active subscriptions: {e}")
-            raise 
\ No newline at end of file
+            raise
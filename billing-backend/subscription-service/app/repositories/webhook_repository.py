@@ -1,7 +1,8 @@
-from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert
 
 from app.models.payment_webhook_request import PaymentWebhookRequest
 from .base_repository import BaseRepository
@@ -17,15 +18,44 @@ class WebhookRepository(BaseRepository[PaymentWebhookRequest]):
         """Get webhook request by event ID."""
         return await self.get_by_field("event_id", event_id)
     
-    async def get_unprocessed_webhooks(self) -> List[PaymentWebhookRequest]:
-        """Get all unprocessed webhook requests."""
-        return await self.get_all(filters={"processed": False})
+    async def get_by_event_ids(self, event_ids: List[str]) -> Dict[str, PaymentWebhookRequest]:
+        """Get webhook requests for several event IDs in one query, keyed by event ID."""
+        if not event_ids:
+            return {}
+        
+        try:
+            query = select(PaymentWebhookRequest).where(
+                PaymentWebhookRequest.event_id.in_(event_ids)
+            )
+            
+            result = await self.session.execute(query)
+            return {webhook.event_id: webhook for webhook in result.scalars().all()}
+        except Exception as e:
+            self.logger.error(f"Error getting webhooks for {len(event_ids)} event IDs: {e}")
+            raise
+    
+    async def get_unprocessed_webhooks(self, limit: int = 100) -> List[PaymentWebhookRequest]:
+        """Get unprocessed webhook requests, oldest first."""
+        try:
+            # IS FALSE matches the idx_webhook_pending partial index predicate
+            query = (
+                select(PaymentWebhookRequest)
+                .where(PaymentWebhookRequest.processed.is_(False))
+                .order_by(PaymentWebhookRequest.created_at)
+                .limit(limit)
+            )
+            
+            result = await self.session.execute(query)
+            return result.scalars().all()
+        except Exception as e:
+            self.logger.error(f"Error getting unprocessed webhooks: {e}")
+            raise
     
     async def get_failed_webhooks(self, max_retries: int = 5) -> List[PaymentWebhookRequest]:
         """Get webhook requests that have failed processing."""
         try:
             query = select(PaymentWebhookRequest).where(
-                PaymentWebhookRequest.processed == False,
+                PaymentWebhookRequest.processed.is_(False),
                 PaymentWebhookRequest.retry_count >= max_retries
             )
             
@@ -39,20 +69,64 @@ class WebhookRepository(BaseRepository[PaymentWebhookRequest]):
         """Mark webhook as processed."""
         return await self.update(webhook_id, {
             "processed": True,
-            "processed_at": datetime.utcnow()
+            "processed_at": func.now()
         })
     
     async def increment_retry_count(self, webhook_id: int, error_message: str = None) -> Optional[PaymentWebhookRequest]:
         """Increment retry count and optionally set error message."""
-        webhook = await self.get_by_id(webhook_id)
-        if not webhook:
-            return None
-        
-        update_data = {"retry_count": webhook.retry_count + 1}
-        if error_message:
-            update_data["error_message"] = error_message
+        try:
+            values = {"retry_count": PaymentWebhookRequest.retry_count + 1}
+            if error_message:
+                values["error_message"] = error_message
+            
+            # Increment in the database so concurrent retries cannot lose updates
+            stmt = (
+                update(PaymentWebhookRequest)
+                .where(PaymentWebhookRequest.id == webhook_id)
+                .values(**values)
+                .returning(PaymentWebhookRequest)
+            )
+            query = select(PaymentWebhookRequest).from_statement(stmt).execution_options(populate_existing=True)
+            result = await self.session.execute(query)
+            return result.scalar_one_or_none()
+        except Exception as e:
+            self.logger.error(f"Error incrementing retry count for webhook {webhook_id}: {e}")
+            await self.session.rollback()
+            raise
+    
+    async def upsert_pending(self, event_id: str, payload: dict, content_hash: Optional[str] = None) -> Optional[int]:
+        """
+        Record a webhook in one statement, returning its ID while it is still unprocessed.
         
-        return await self.update(webhook_id, update_data)
+        New events are inserted; unprocessed ones get the new payload. An
+        already-processed event is left alone and None is returned, as is an
+        event whose content hash was already recorded under another event ID.
+        """
+        try:
+            stmt = insert(PaymentWebhookRequest).values(
+                event_id=event_id,
+                payload=payload,
+                content_hash=content_hash,
+                processed=False,
+                retry_count=0
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["event_id"],
+                set_={"payload": stmt.excluded.payload},
+                where=PaymentWebhookRequest.processed.is_(False)
+            ).returning(PaymentWebhookRequest.id)
+            
+            result = await self.session.execute(stmt)
+            return result.scalar_one_or_none()
+        except IntegrityError:
+            # Unique content_hash hit: same webhook content under a different event_id
+            self.logger.info(f"Webhook {event_id} duplicates recorded content {content_hash}")
+            await self.session.rollback()
+            return None
+        except Exception as e:
+            self.logger.error(f"Error upserting webhook {event_id}: {e}")
+            await self.session.rollback()
+            raise
     
     async def create_webhook_request(self, event_id: str, payload: dict) -> PaymentWebhookRequest:
         """Create a new webhook request."""
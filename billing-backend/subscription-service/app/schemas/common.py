@@ -1,8 +1,9 @@
 from datetime import datetime
 from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, validator
 from enum import Enum
 from uuid import UUID
+import orjson
 
 
 # Path Parameter Validation Schemas
@@ -54,11 +55,17 @@ class BaseResponse(BaseModel):
     success: bool = True
     message: Optional[str] = None
     
-    class Config:
-        orm_mode = True
-        json_encoders = {
-            # Add custom encoders if needed
-        }
+    # Pydantic v2 config; UUID/datetime need no custom encoders in model_dump(mode="json")
+    model_config = ConfigDict(from_attributes=True)
+    
+    def to_orjson_bytes(self) -> bytes:
+        """
+        Serialize straight to JSON bytes with orjson.
+        
+        Endpoints can return these in a Response to skip FastAPI's
+        jsonable_encoder pass; datetime and UUID are handled natively.
+        """
+        return orjson.dumps(self.model_dump(), default=str)
 
 
 class SuccessResponse(BaseResponse):
@@ -200,7 +207,6 @@ class DateRangeParams(BaseModel):
         """Validate date format."""
         if v is not None:
             try:
-                from datetime import datetime
                 datetime.strptime(v, '%Y-%m-%d')
             except ValueError:
                 raise ValueError('Invalid date format. Use YYYY-MM-DD')
@@ -54,8 +54,8 @@ class PlanResponse(BaseResponse):
     
     @classmethod
     def from_orm(cls, plan):
-        """Create response from ORM object."""
-        return cls(
+        """Create response from ORM object (trusted data, so validation is skipped)."""
+        return cls.model_construct(
             id=plan.id,
             name=plan.name,
             description=plan.description,
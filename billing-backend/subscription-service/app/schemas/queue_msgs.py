@@ -0,0 +1,20 @@
+from typing import Any, Dict
+import msgspec
+
+
+class RenewalCheckMsg(msgspec.Struct):
+    """Scheduled renewal-check trigger pushed to queue:subscription_renewal_check."""
+    
+    task: str
+    scheduled_at: str
+    retry_count: int = 0
+    max_retries: int = 1
+
+
+class FailedMsg(msgspec.Struct):
+    """Dead-letter wrapper around a message that could not be processed."""
+    
+    original: Dict[str, Any]
+    failed_at: str
+    error_message: str
+    original_queue: str
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Iterable, AsyncIterator, Literal
 from uuid import UUID
 from pydantic import BaseModel, Field
 
@@ -7,12 +7,15 @@ from .common import BaseResponse
 from .user import UserResponse
 from .plan import PlanResponse
 
+# Literal validation is a set lookup in pydantic-core, cheaper than a regex match
+SubStatus = Literal["pending", "active", "trial", "past_due", "cancelled", "revoked"]
+
 
 class SubscriptionBase(BaseModel):
     """Base subscription schema."""
     
     plan_id: int
-    status: str = Field(..., pattern="^(pending|active|trial|past_due|cancelled|revoked)$")
+    status: SubStatus
 
 
 class SubscriptionCreate(SubscriptionBase):
@@ -24,7 +27,7 @@ class SubscriptionUpdate(BaseModel):
     """Schema for updating a subscription."""
     
     plan_id: Optional[int] = None
-    status: Optional[str] = Field(None, pattern="^(pending|active|trial|past_due|cancelled|revoked)$")
+    status: Optional[SubStatus] = None
 
 
 class SubscriptionCreateRequest(BaseModel):
@@ -51,7 +54,7 @@ class SubscriptionResponse(BaseResponse):
     id: UUID
     user_id: int
     plan_id: int
-    status: str
+    status: SubStatus
     start_date: datetime
     end_date: datetime
     canceled_at: Optional[datetime]
@@ -68,8 +71,13 @@ class SubscriptionResponse(BaseResponse):
     
     @classmethod
     def from_orm(cls, subscription, include_user: bool = False, include_plan: bool = False):
-        """Create response from ORM object."""
-        data = cls(
+        """Create response from ORM object (trusted data, so validation is skipped)."""
+        # Build embedded objects first so the response is constructed once, with no
+        # attribute assignment afterwards
+        user = UserResponse.from_orm(subscription.user) if include_user and subscription.user else None
+        plan = PlanResponse.from_orm(subscription.plan) if include_plan and subscription.plan else None
+        
+        return cls.model_construct(
             id=subscription.id,
             user_id=subscription.user_id,
             plan_id=subscription.plan_id,
@@ -82,16 +90,10 @@ class SubscriptionResponse(BaseResponse):
             is_trial=subscription.is_trial,
             days_remaining=subscription.days_remaining,
             created_at=subscription.created_at,
-            updated_at=subscription.updated_at
+            updated_at=subscription.updated_at,
+            user=user,
+            plan=plan
         )
-        
-        if include_user and subscription.user:
-            data.user = UserResponse.from_orm(subscription.user)
-        
-        if include_plan and subscription.plan:
-            data.plan = PlanResponse.from_orm(subscription.plan)
-        
-        return data
 
 
 class SubscriptionListResponse(BaseResponse):
@@ -100,4 +102,15 @@ class SubscriptionListResponse(BaseResponse):
     subscriptions: List[SubscriptionResponse]
     total: int
     page: int
-    limit: int 
\ No newline at end of file
+    limit: int
+
+
+async def stream_subscription_rows(rows: Iterable[SubscriptionResponse]) -> AsyncIterator[bytes]:
+    """Yield a JSON array of built subscription responses one encoded row at a time."""
+    yield b"["
+    for index, row in enumerate(rows):
+        if index:
+            yield b","
+        # Same JSON-mode encoding the response_model would use (UTC as "Z")
+        yield row.model_dump_json().encode()
+    yield b"]"
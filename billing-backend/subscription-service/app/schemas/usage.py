@@ -1,6 +1,7 @@
 from datetime import datetime
+from functools import cached_property
 from typing import Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, computed_field
 
 from .common import BaseResponse
 
@@ -21,14 +22,16 @@ class UsageCheckResponse(BaseResponse):
     remaining: int
     reset_at: Optional[datetime] = None
     
-    @property
-    def usage_percentage(self) -> float:
-        """Calculate usage percentage."""
+    @computed_field
+    @cached_property
+    def usage_percentage(self) -> int:
+        """Calculate usage percentage (whole percent, computed once per instance)."""
         if self.limit <= 0:
-            return 0.0
-        return (self.current_usage / self.limit) * 100
+            return 0
+        return (self.current_usage * 100) // self.limit
     
-    @property
+    @computed_field
+    @cached_property
     def is_limit_exceeded(self) -> bool:
         """Check if usage limit is exceeded."""
         return self.current_usage >= self.limit
@@ -47,8 +50,8 @@ class UsageResponse(BaseResponse):
     
     @classmethod
     def from_orm(cls, usage, limit: int):
-        """Create response from ORM object."""
-        return cls(
+        """Create response from ORM object (trusted data, so validation is skipped)."""
+        return cls.model_construct(
             user_id=usage.user_id,
             feature_name=usage.feature_name,
             usage_count=usage.usage_count,
@@ -39,8 +39,8 @@ class UserResponse(BaseResponse):
     
     @classmethod
     def from_orm(cls, user):
-        """Create response from ORM object."""
-        return cls(
+        """Create response from ORM object (trusted data, so validation is skipped)."""
+        return cls.model_construct(
             id=user.id,
             email=user.email,
             first_name=user.first_name,
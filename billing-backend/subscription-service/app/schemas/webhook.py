@@ -1,6 +1,7 @@
 from datetime import datetime
 from typing import Dict, Any, Optional
 from uuid import UUID
+import msgspec
 from pydantic import BaseModel, Field
 
 from .common import BaseResponse
@@ -19,6 +20,19 @@ class WebhookPayload(BaseModel):
     metadata: Optional[Dict[str, Any]] = Field(default_factory=dict)
 
 
+class WebhookPayloadMsg(msgspec.Struct):
+    """Queued webhook payload, decoded and validated in one pass by the worker."""
+    
+    event_id: str
+    transaction_id: UUID
+    subscription_id: UUID
+    status: str
+    amount: float
+    occurred_at: datetime
+    currency: str = "AED"
+    metadata: Optional[Dict[str, Any]] = msgspec.field(default_factory=dict)
+
+
 class WebhookResponse(BaseResponse):
     """Schema for webhook response."""
     
@@ -1,7 +1,10 @@
 from abc import ABC
-from typing import Optional
+from functools import cached_property
+from typing import Any, Dict, List, Optional
+import time
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.core.config import settings
 from app.core.logging import get_logger
 from app.core.redis_client import redis_client
 from app.repositories import (
@@ -20,27 +23,74 @@ class BaseService(ABC):
         self.session = session
         self.logger = get_logger(self.__class__.__name__)
         
-        # Initialize repositories
-        self.user_repo = UserRepository(session)
-        self.plan_repo = PlanRepository(session)
-        self.subscription_repo = SubscriptionRepository(session)
-        self.usage_repo = UsageRepository(session)
-        self.webhook_repo = WebhookRepository(session)
-        
         # Redis client for queue operations
         self.redis = redis_client
+        
+        # Subscription events held until commit: pushed to the Redis outbox when
+        # enabled, otherwise bulk-inserted just before the transaction commits
+        self._pending_events: List[Dict[str, Any]] = []
+        self._pending_event_rows: List[Dict[str, Any]] = []
+    
+    # Repositories are created on first access; most requests only touch one or two
+    @cached_property
+    def user_repo(self) -> UserRepository:
+        return UserRepository(self.session)
+    
+    @cached_property
+    def plan_repo(self) -> PlanRepository:
+        return PlanRepository(self.session)
+    
+    @cached_property
+    def subscription_repo(self) -> SubscriptionRepository:
+        return SubscriptionRepository(self.session)
+    
+    @cached_property
+    def usage_repo(self) -> UsageRepository:
+        return UsageRepository(self.session)
+    
+    @cached_property
+    def webhook_repo(self) -> WebhookRepository:
+        return WebhookRepository(self.session)
+    
+    def _record_event(self, event_data: Dict[str, Any]):
+        """
+        Record a subscription event as part of the current unit of work.
+        
+        With SUBSCRIPTION_EVENT_OUTBOX enabled the event is stamped now and
+        pushed to Redis after a successful commit; otherwise it is inserted
+        in the same transaction by commit(), as a Core INSERT rather than a
+        tracked ORM object since events are write-once.
+        """
+        if settings.SUBSCRIPTION_EVENT_OUTBOX:
+            self._pending_events.append({**event_data, "ts": time.time()})
+        else:
+            self._pending_event_rows.append(event_data)
     
     async def commit(self):
         """Commit the current transaction."""
         try:
+            if self._pending_event_rows:
+                rows, self._pending_event_rows = self._pending_event_rows, []
+                # Sessions run with autoflush=False; write the rows these events
+                # reference (e.g. a just-added subscription) before inserting them
+                await self.session.flush()
+                await self.subscription_repo.bulk_insert_events(rows)
             await self.session.commit()
         except Exception as e:
             self.logger.error(f"Error committing transaction: {e}")
             await self.session.rollback()
+            self._pending_events.clear()
+            self._pending_event_rows.clear()
             raise
+        
+        if self._pending_events:
+            events, self._pending_events = self._pending_events, []
+            await self.redis.push_subscription_events(events)
     
     async def rollback(self):
         """Rollback the current transaction."""
+        self._pending_events.clear()
+        self._pending_event_rows.clear()
         try:
             await self.session.rollback()
         except Exception as e:
@@ -1,16 +1,56 @@
-import json
 import time
-from typing import Dict, Any, List, Optional
-from datetime import datetime
+import msgspec
+import orjson
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Union
+from datetime import datetime, timezone
 
 from app.core.config import settings
+from app.schemas.queue_msgs import RenewalCheckMsg, FailedMsg
 from .base_service import BaseService
 
+# Queues polled for ready delayed messages
+_DELAYED_QUEUES = (
+    "queue:payment_initiation",
+    "queue:payment_webhook_processing",
+    "queue:subscription_renewal",
+    "queue:plan_change",
+    "queue:usage_sync",
+    "queue:renewal_retry",
+)
+
+# Queues reported by get_queue_stats, with their delayed/failed keys precomputed
+_STATS_QUEUES = (
+    "queue:payment_initiation",
+    "queue:trial_payment",
+    "queue:payment_webhook_processing",
+    "queue:subscription_renewal",
+    "queue:plan_change",
+    "queue:usage_sync",
+    "queue:renewal_retry",
+)
+_QUEUE_TRIPLES = tuple((q, f"{q}:delayed", f"{q}:failed") for q in _STATS_QUEUES)
+
+
+@lru_cache(maxsize=2)
+def _format_utc_second(epoch_second: int) -> str:
+    return datetime.fromtimestamp(epoch_second, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _utcnow_iso() -> str:
+    """Current UTC time as an ISO-8601 string, formatted at most once per second."""
+    return _format_utc_second(int(time.time()))
+
 
 class QueueService(BaseService):
     """Service for managing Redis-based message queues."""
     
-    async def queue_message(self, queue_name: str, message: Dict[str, Any], delay_seconds: int = 0):
+    async def queue_message(
+        self,
+        queue_name: str,
+        message: Union[Dict[str, Any], msgspec.Struct],
+        delay_seconds: int = 0
+    ):
         """Queue a message with optional delay."""
         try:
             if delay_seconds > 0:
@@ -21,7 +61,7 @@ class QueueService(BaseService):
             self.logger.debug(f"Message queued",
                             queue=queue_name,
                             delay=delay_seconds,
-                            message_id=message.get("id"))
+                            message_id=message.get("id") if isinstance(message, dict) else getattr(message, "id", None))
         
         except Exception as e:
             self.logger.error(f"Error queuing message: {e}")
@@ -29,25 +69,10 @@ class QueueService(BaseService):
     
     async def process_delayed_queues(self):
         """Process delayed messages that are ready."""
-        delayed_queues = [
-            "queue:payment_initiation",
-            "queue:payment_webhook_processing", 
-            "queue:subscription_renewal",
-            "queue:plan_change",
-            "queue:usage_sync",
-            "queue:renewal_retry"
-        ]
-        
         try:
-            total_processed = 0
-            
-            for queue_name in delayed_queues:
-                ready_messages = await self.redis.get_ready_delayed_messages(queue_name)
-                
-                for message_str in ready_messages:
-                    # Move to primary queue
-                    await self.redis.queue_message(queue_name, json.loads(message_str))
-                    total_processed += 1
+            # One pipelined round trip; messages move server-side without decoding
+            moved = await self.redis.move_ready_delayed_batch(_DELAYED_QUEUES)
+            total_processed = sum(moved.values())
             
             if total_processed > 0:
                 self.logger.info(f"Processed delayed messages", count=total_processed)
@@ -61,23 +86,19 @@ class QueueService(BaseService):
     async def get_queue_stats(self) -> Dict[str, Any]:
         """Get statistics for all queues."""
         try:
-            queue_names = [
-                "queue:payment_initiation",
-                "queue:trial_payment",
-                "queue:payment_webhook_processing",
-                "queue:subscription_renewal", 
-                "queue:plan_change",
-                "queue:usage_sync",
-                "queue:renewal_retry"
-            ]
-            
             stats = {}
             total_depth = 0
             
-            for queue_name in queue_names:
-                depth = await self.redis.get_queue_length(queue_name)
-                delayed_depth = await self.redis.get_queue_length(f"{queue_name}:delayed")
-                failed_depth = await self.redis.get_queue_length(f"{queue_name}:failed")
+            # Send all depth probes in one round trip; delayed queues are ZSETs, so ZCARD
+            async with self.redis.client.pipeline(transaction=False) as pipe:
+                for queue_name, delayed_queue, failed_queue in _QUEUE_TRIPLES:
+                    pipe.llen(queue_name)
+                    pipe.zcard(delayed_queue)
+                    pipe.llen(failed_queue)
+                results = await pipe.execute()
+            
+            for index, queue_name in enumerate(_STATS_QUEUES):
+                depth, delayed_depth, failed_depth = results[index * 3:index * 3 + 3]
                 
                 stats[queue_name] = {
                     "active_depth": depth,
@@ -89,9 +110,9 @@ class QueueService(BaseService):
                 total_depth += stats[queue_name]["total_depth"]
             
             stats["summary"] = {
-                "total_queues": len(queue_names),
+                "total_queues": len(_STATS_QUEUES),
                 "total_depth": total_depth,
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": _utcnow_iso()
             }
             
             return stats
@@ -132,15 +153,20 @@ class QueueService(BaseService):
         try:
             cleared_counts = {}
             
-            # Clear main queue
+            # Clear main queue; UNLINK frees large lists off the Redis event loop
             if self.redis.client:
-                cleared_counts["active"] = await self.redis.client.delete(queue_name)
+                keys = {"active": queue_name}
                 
                 if include_delayed:
-                    cleared_counts["delayed"] = await self.redis.client.delete(f"{queue_name}:delayed")
+                    keys["delayed"] = f"{queue_name}:delayed"
                 
                 if include_failed:
-                    cleared_counts["failed"] = await self.redis.client.delete(f"{queue_name}:failed")
+                    keys["failed"] = f"{queue_name}:failed"
+                
+                pipe = self.redis.client.pipeline(transaction=False)
+                for key in keys.values():
+                    pipe.unlink(key)
+                cleared_counts = dict(zip(keys, await pipe.execute()))
             
             self.logger.info(f"Queue cleared",
                            queue=queue_name,
@@ -160,12 +186,18 @@ class QueueService(BaseService):
             
             # Use LRANGE to peek at messages
             message_strings = await self.redis.client.lrange(queue_name, 0, count - 1)
-            messages = []
             
+            # Decode the whole batch as one JSON array; fall back per message only if one is invalid
+            try:
+                return orjson.loads("[" + ",".join(message_strings) + "]")
+            except orjson.JSONDecodeError:
+                pass
+            
+            messages = []
             for msg_str in message_strings:
                 try:
-                    messages.append(json.loads(msg_str))
-                except json.JSONDecodeError:
+                    messages.append(orjson.loads(msg_str))
+                except orjson.JSONDecodeError:
                     self.logger.warning(f"Invalid JSON in queue message", queue=queue_name)
             
             return messages
@@ -177,12 +209,12 @@ class QueueService(BaseService):
     async def move_message_to_failed(self, queue_name: str, message: Dict[str, Any], error_message: str):
         """Move a message to the failed queue."""
         try:
-            failed_message = {
-                **message,
-                "failed_at": datetime.utcnow().isoformat(),
-                "error_message": error_message,
-                "original_queue": queue_name
-            }
+            failed_message = FailedMsg(
+                original=message,
+                failed_at=_utcnow_iso(),
+                error_message=error_message,
+                original_queue=queue_name
+            )
             
             failed_queue = f"{queue_name}:failed"
             await self.redis.queue_message(failed_queue, failed_message)
@@ -200,12 +232,10 @@ class QueueService(BaseService):
         """Schedule renewal check for expiring subscriptions."""
         try:
             # This would typically be called by a cron job
-            renewal_check_message = {
-                "task": "renewal_check",
-                "scheduled_at": datetime.utcnow().isoformat(),
-                "retry_count": 0,
-                "max_retries": 1
-            }
+            renewal_check_message = RenewalCheckMsg(
+                task="renewal_check",
+                scheduled_at=_utcnow_iso()
+            )
             
             await self.redis.queue_message("queue:subscription_renewal_check", renewal_check_message)
             
@@ -1,15 +1,23 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict, Any
 from uuid import UUID
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 
 from app.models.subscription import Subscription
-from app.models.subscription_event import SubscriptionEvent
 from app.schemas.subscription import SubscriptionCreateRequest, TrialSubscriptionRequest
 from app.core.config import settings
 from .base_service import BaseService
 from app.schemas.queue import QueueMessageEnvelope
 import hashlib
+import time
+import orjson
+
+
+def _idempotency_key(*parts: Any) -> str:
+    """Hour-bucketed idempotency key for payment messages (BLAKE2b-128, 32 hex chars)."""
+    raw = ":".join(str(part) for part in parts) + f":{int(time.time()) // 3600}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
 
 
 class SubscriptionService(BaseService):
@@ -29,8 +37,8 @@ class SubscriptionService(BaseService):
                 raise ValueError(f"Plan with ID {request.plan_id} not found or inactive")
             
             # Check for existing active subscription
-            existing_subscription = await self.subscription_repo.get_active_subscription_by_user(request.user_id)
-            if existing_subscription:
+            open_states = await self.subscription_repo.get_open_subscription_states(request.user_id)
+            if any(is_current for _, is_current in open_states):
                 raise ValueError(f"User {request.user_id} already has an active subscription")
             
             # Calculate subscription dates
@@ -58,16 +66,16 @@ class SubscriptionService(BaseService):
                 "event_metadata": {"plan_name": plan.name, "amount": float(plan.price)}
             }
             
-            event = SubscriptionEvent(**event_data)
-            self.session.add(event)
+            self._record_event(event_data)
             
             # Queue payment initiation
             await self._queue_payment_initiation(subscription.id, float(plan.price))
             
-            # Load plan relationship before committing for response serialization
-            await self.session.refresh(subscription, ["plan"])
+            # Attach the plan already loaded above for response serialization (no extra SELECT)
+            set_committed_value(subscription, "plan", plan)
             
             await self.commit()
+            await self.redis.invalidate_active_sub(request.user_id)
             
             self.logger.info(f"Subscription created", 
                            subscription_id=str(subscription.id), 
@@ -94,25 +102,12 @@ class SubscriptionService(BaseService):
             if not plan or not plan.is_active or not plan.is_trial_plan:
                 raise ValueError(f"Trial plan with ID {request.trial_plan_id} not found or invalid")
             
-            # Check for existing active subscription
-            existing_subscription = await self.subscription_repo.get_active_subscription_by_user(request.user_id)
-            if existing_subscription:
+            # Check for existing active and pending subscriptions in one query
+            open_states = await self.subscription_repo.get_open_subscription_states(request.user_id)
+            if any(is_current for _, is_current in open_states):
                 raise ValueError(f"User {request.user_id} already has an active subscription")
             
-            # Check for existing pending subscriptions by querying directly
-            from sqlalchemy import select, and_
-            from app.models.subscription import Subscription as SubscriptionModel
-            
-            pending_query = select(SubscriptionModel).where(
-                and_(
-                    SubscriptionModel.user_id == request.user_id,
-                    SubscriptionModel.status.in_(["pending"])
-                )
-            )
-            result = await self.session.execute(pending_query)
-            pending_subscription = result.scalars().first()
-            
-            if pending_subscription:
+            if any(status == "pending" for status, _ in open_states):
                 raise ValueError(f"User {request.user_id} already has a pending subscription")
             
             # Calculate trial dates
@@ -137,22 +132,22 @@ class SubscriptionService(BaseService):
                 "event_type": "trial_started",
                 "event_metadata": {
                     "trial_days": trial_days,
-                    "start_date": start_date.isoformat(),
-                    "end_date": end_date.isoformat(),
+                    "start_ts": int(start_date.replace(tzinfo=timezone.utc).timestamp()),
+                    "end_ts": int(end_date.replace(tzinfo=timezone.utc).timestamp()),
                     "status": "pending"
                 }
             }
             
-            event = SubscriptionEvent(**event_data)
-            self.session.add(event)
+            self._record_event(event_data)
             
             # Queue trial payment (1 AED charge + immediate refund)
             await self._queue_trial_payment(subscription.id)
             
-            # Load plan relationship before committing for response serialization
-            await self.session.refresh(subscription, ["plan"])
+            # Attach the plan already loaded above for response serialization (no extra SELECT)
+            set_committed_value(subscription, "plan", plan)
             
             await self.commit()
+            await self.redis.invalidate_active_sub(request.user_id)
             
             self.logger.info(
                 f"Trial subscription created",
@@ -187,7 +182,7 @@ class SubscriptionService(BaseService):
             current_plan = subscription.plan
             
             # For upgrades, initiate a payment with action 'upgrade'
-            idemp = hashlib.sha256(f"{subscription_id}:upgrade:{new_plan_id}:{int(datetime.utcnow().timestamp())//3600}".encode()).hexdigest()
+            idemp = _idempotency_key(subscription_id, "upgrade", new_plan_id)
             envelope = QueueMessageEnvelope(
                 action="upgrade",
                 correlation_id=str(subscription_id),
@@ -200,7 +195,8 @@ class SubscriptionService(BaseService):
                     "currency": "AED"
                 }
             )
-            await self.redis.queue_message("q:sub:payment_initiation", envelope.model_dump())
+            await self.redis.queue_raw("q:sub:payment_initiation", envelope.model_dump_json())
+            await self.redis.invalidate_active_sub(subscription.user_id)
             
             self.logger.info(f"Plan change queued", 
                            subscription_id=str(subscription_id),
@@ -233,10 +229,10 @@ class SubscriptionService(BaseService):
                 "event_metadata": {"cancelled_by": "user", "cancellation_reason": "immediate"}
             }
             
-            event = SubscriptionEvent(**event_data)
-            self.session.add(event)
+            self._record_event(event_data)
             
             await self.commit()
+            await self.redis.invalidate_active_sub(subscription.user_id)
             
             self.logger.info(f"Subscription cancelled", 
                            subscription_id=str(subscription_id))
@@ -263,23 +259,21 @@ class SubscriptionService(BaseService):
     async def process_subscription_renewal(self, subscription_id: UUID) -> bool:
         """Process subscription renewal (called by worker)."""
         try:
-            subscription = await self.subscription_repo.get_with_relationships(subscription_id)
+            # Only the plan is needed here; user and events are not touched
+            subscription = await self.subscription_repo.get_by_id(subscription_id, relationships=["plan"])
             if not subscription:
                 self.logger.error(f"Subscription {subscription_id} not found for renewal")
                 return False
             
-            current_plan = subscription.plan
-            renewal_amount = float(current_plan.price)
+            renewal_amount = float(subscription.plan.price)
             
-            # For trial subscriptions, check if there's a renewal plan
+            # For trial subscriptions, switch to the renewal plan (if any) in one UPDATE
             if subscription.is_trial:
-                renewal_plan = await self.plan_repo.get_renewal_plan(current_plan.id)
-                if renewal_plan:
-                    # Update subscription to use renewal plan
-                    await self.subscription_repo.update(subscription_id, {
-                        "plan_id": renewal_plan.id
-                    })
-                    renewal_amount = float(renewal_plan.price)
+                renewal = await self.subscription_repo.switch_to_renewal_plan(subscription_id)
+                if renewal:
+                    _, renewal_price, _ = renewal
+                    renewal_amount = float(renewal_price)
+                    await self.redis.invalidate_active_sub(subscription.user_id)
             
             # Queue payment for renewal
             await self._queue_payment_initiation(subscription_id, renewal_amount, is_renewal=True)
@@ -294,11 +288,43 @@ class SubscriptionService(BaseService):
             self.logger.error(f"Error processing subscription renewal: {e}")
             return False
     
+    async def flush_event_outbox(self, batch_size: int = 500) -> int:
+        """Bulk-insert subscription events buffered in the Redis outbox (called by worker)."""
+        flushed = 0
+        while True:
+            entries = await self.redis.drain_subscription_events(batch_size)
+            if not entries:
+                break
+            
+            rows = []
+            for entry in entries:
+                event = orjson.loads(entry)
+                # Enqueue time becomes created_at so the audit trail keeps request order
+                created_at = datetime.fromtimestamp(event.pop("ts"), tz=timezone.utc)
+                rows.append({
+                    **event,
+                    "subscription_id": UUID(event["subscription_id"]),
+                    "transaction_id": UUID(event["transaction_id"]) if event.get("transaction_id") else None,
+                    "effective_at": datetime.fromisoformat(event["effective_at"]) if event.get("effective_at") else None,
+                    "created_at": created_at
+                })
+            
+            try:
+                flushed += await self.subscription_repo.bulk_insert_events(rows)
+                await self.commit()
+            except Exception:
+                await self.redis.requeue_subscription_events(entries)
+                raise
+            
+            if len(entries) < batch_size:
+                break
+        
+        return flushed
+    
     async def _queue_payment_initiation(self, subscription_id: UUID, amount: float, is_renewal: bool = False):
         """Queue payment initiation message (enveloped)."""
-        import hashlib
         action = "renewal" if is_renewal else "initial"
-        idemp = hashlib.sha256(f"{subscription_id}:{action}:{int(datetime.utcnow().timestamp())//3600}".encode()).hexdigest()
+        idemp = _idempotency_key(subscription_id, action)
         envelope = QueueMessageEnvelope(
             action=action,
             correlation_id=str(subscription_id),
@@ -310,11 +336,11 @@ class SubscriptionService(BaseService):
                 "renewal": is_renewal
             }
         )
-        await self.redis.queue_message("q:sub:payment_initiation", envelope.model_dump())
+        await self.redis.queue_raw("q:sub:payment_initiation", envelope.model_dump_json())
  
     async def _queue_trial_payment(self, subscription_id: UUID):
         """Queue trial payment message (enveloped)."""
-        idemp = hashlib.sha256(f"{subscription_id}:trial:{int(datetime.utcnow().timestamp())//3600}".encode()).hexdigest()
+        idemp = _idempotency_key(subscription_id, "trial")
         envelope = QueueMessageEnvelope(
             action="trial",
             correlation_id=str(subscription_id),
@@ -326,6 +352,6 @@ class SubscriptionService(BaseService):
                 "trial": True
             }
         )
-        await self.redis.queue_message("q:sub:trial_payment", envelope.model_dump()) 
+        await self.redis.queue_raw("q:sub:trial_payment", envelope.model_dump_json()) 
 
     
\ No newline at end of file
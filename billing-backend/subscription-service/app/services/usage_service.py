@@ -1,7 +1,9 @@
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple
 from uuid import UUID
 import json
+import time
 
 from app.models.user_usage import UserUsage
 from app.schemas.usage import UsageCheckResponse, UsageResponse, UsageStatsResponse
@@ -9,9 +11,68 @@ from app.core.config import settings
 from .base_service import BaseService
 
 
+@lru_cache(maxsize=4)
+def _month_bounds(year: int, month: int) -> Tuple[datetime, datetime, str]:
+    """(period_start, next_month_first, next_month_first as epoch string) for a month."""
+    period_start = datetime(year, month, 1)
+    next_month_first = (period_start + timedelta(days=32)).replace(day=1)
+    return period_start, next_month_first, str(int(next_month_first.timestamp()))
+
+
+def _current_month_bounds() -> Tuple[datetime, datetime, str]:
+    """Month bounds for the current UTC month; recomputed only on rollover."""
+    now = datetime.utcnow()
+    return _month_bounds(now.year, now.month)
+
+
 class UsageService(BaseService):
     """Service for usage tracking and management operations."""
     
+    async def _get_active_sub_cached(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Return the user's active subscription summary, served from Redis when cached.
+        
+        The summary carries only what feature gating needs (ids, status and
+        plan limits), so a cache hit skips the subscription query entirely.
+        The subscription's end is cached with it: a hit past that point is a
+        miss, and the entry never outlives the subscription.
+        """
+        now_ts = int(time.time())
+        cached = await self.redis.get_active_sub(user_id)
+        if cached and int(cached.get("end_ts", 0)) > now_ts:
+            return {
+                "subscription_id": cached["subscription_id"],
+                "plan_id": int(cached["plan_id"]),
+                "status": cached["status"],
+                "limits": json.loads(cached["limits_json"])
+            }
+        
+        row = await self.subscription_repo.get_active_subscription_summary(user_id)
+        if not row:
+            return None
+        
+        subscription_id, plan_id, status, end_date, limits = row
+        summary = {
+            "subscription_id": str(subscription_id),
+            "plan_id": plan_id,
+            "status": status,
+            "limits": limits
+        }
+        end_ts = int(end_date.replace(tzinfo=timezone.utc).timestamp())
+        if end_ts > now_ts:
+            await self.redis.set_active_sub(
+                user_id,
+                {
+                    "subscription_id": summary["subscription_id"],
+                    "plan_id": str(summary["plan_id"]),
+                    "status": summary["status"],
+                    "end_ts": str(end_ts),
+                    "limits_json": json.dumps(summary["limits"])
+                },
+                min(settings.ACTIVE_SUB_CACHE_TTL, end_ts - now_ts)
+            )
+        return summary
+    
     async def use_feature(self, user_id: int, feature_name: str, delta: int = 1) -> UsageCheckResponse:
         """
         Use a feature atomically with Redis-based limit checking.
@@ -21,21 +82,18 @@ class UsageService(BaseService):
         """
         try:
             # Get user's active subscription to determine limits
-            subscription = await self.subscription_repo.get_active_subscription_by_user(user_id)
-            if not subscription:
+            active_sub = await self._get_active_sub_cached(user_id)
+            if not active_sub:
                 raise ValueError(f"No active subscription found for user {user_id}")
             
-            plan = subscription.plan
-            feature_limits = plan.get_feature_limits()
+            feature_limits = active_sub["limits"]
             feature_limit = feature_limits.get(feature_name, 0)
             
             if feature_limit <= 0:
                 raise ValueError(f"Feature '{feature_name}' is not available in current plan")
             
-            # Calculate reset time for Redis (first day of next month as epoch string)
-            now = datetime.utcnow()
-            next_month_first = (now.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            reset_at_str = str(int(next_month_first.timestamp()))
+            # Reset time for Redis (first day of next month as epoch string)
+            _, next_month_first, reset_at_str = _current_month_bounds()
             
             # Use Redis atomic helper for usage checking and incrementing
             result = await self.redis.atomic_usage_check(
@@ -50,9 +108,8 @@ class UsageService(BaseService):
             limit = int(result.get('limit', feature_limit))
             success = bool(result.get('success', False))
             
-            # Only sync to database when increment succeeds
-            if success:
-                await self._sync_usage_to_db(user_id, feature_name, current_usage)
+            # Successful increments are queued on usage:dirty by the Lua script
+            # and written to the database by sync_usage_schedule
             
             # Calculate reset time (monthly reset) for API response
             reset_at = next_month_first
@@ -69,18 +126,22 @@ class UsageService(BaseService):
             self.logger.error(f"Error using feature {feature_name} for user {user_id}: {e}")
             raise
     
+    async def get_user_snapshot(self, user_id: int) -> Tuple[Optional[Dict[str, Any]], List[UserUsage]]:
+        """
+        Load a user's active subscription summary and usage records.
+        
+        Both reads use the service session; the subscription summary is
+        usually a Redis hit, so only the usage query reaches the database.
+        """
+        active_sub = await self._get_active_sub_cached(user_id)
+        usage_records = await self.usage_repo.get_user_usage(user_id)
+        return active_sub, usage_records
+    
     async def get_user_usage(self, user_id: int) -> List[UsageResponse]:
         """Get all usage records for a user."""
         try:
-            # Get user's active subscription for limits
-            subscription = await self.subscription_repo.get_active_subscription_by_user(user_id)
-            feature_limits = {}
-            
-            if subscription and subscription.plan:
-                feature_limits = subscription.plan.get_feature_limits()
-            
-            # Get usage records from database
-            usage_records = await self.usage_repo.get_user_usage(user_id)
+            active_sub, usage_records = await self.get_user_snapshot(user_id)
+            feature_limits = active_sub["limits"] if active_sub else {}
             
             results = []
             for usage in usage_records:
@@ -97,12 +158,9 @@ class UsageService(BaseService):
         """Get specific feature usage for a user."""
         try:
             # Get user's active subscription for limits
-            subscription = await self.subscription_repo.get_active_subscription_by_user(user_id)
-            feature_limit = 0
-            
-            if subscription and subscription.plan:
-                feature_limits = subscription.plan.get_feature_limits()
-                feature_limit = feature_limits.get(feature_name, 0)
+            active_sub = await self._get_active_sub_cached(user_id)
+            feature_limits = active_sub["limits"] if active_sub else {}
+            feature_limit = feature_limits.get(feature_name, 0)
             
             # Get usage record from database
             usage = await self.usage_repo.get_user_feature_usage(user_id, feature_name)
@@ -122,20 +180,19 @@ class UsageService(BaseService):
             if feature_name:
                 # Reset specific feature
                 success = await self.usage_repo.reset_usage(user_id, feature_name)
+                await self.commit()
                 
                 # Also clear Redis cache
-                await self.redis.client.delete(f"usage:{user_id}:{feature_name}")
+                await self.redis.reset_usage_counters([(user_id, feature_name)])
                 
                 return 1 if success else 0
             else:
                 # Reset all features for user
                 count = await self.usage_repo.reset_all_user_usage(user_id)
+                await self.commit()
                 
                 # Clear Redis cache for all features
-                keys_pattern = f"usage:{user_id}:*"
-                keys = await self.redis.client.keys(keys_pattern)
-                if keys:
-                    await self.redis.client.delete(*keys)
+                await self.redis.reset_user_usage_counters(user_id)
                 
                 return count
             
@@ -146,15 +203,8 @@ class UsageService(BaseService):
     async def get_usage_stats(self, user_id: int) -> UsageStatsResponse:
         """Get usage statistics for a user."""
         try:
-            # Get user's active subscription
-            subscription = await self.subscription_repo.get_active_subscription_by_user(user_id)
-            feature_limits = {}
-            
-            if subscription and subscription.plan:
-                feature_limits = subscription.plan.get_feature_limits()
-            
-            # Get usage records
-            usage_records = await self.usage_repo.get_user_usage(user_id)
+            active_sub, usage_records = await self.get_user_snapshot(user_id)
+            feature_limits = active_sub["limits"] if active_sub else {}
             
             total_usage = 0
             total_limit = 0
@@ -174,9 +224,8 @@ class UsageService(BaseService):
                 }
             
             # Calculate period
-            now = datetime.utcnow()
-            period_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            period_end = (period_start + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
+            period_start, next_month_first, _ = _current_month_bounds()
+            period_end = next_month_first - timedelta(seconds=1)
             
             return UsageStatsResponse(
                 total_usage=total_usage,
@@ -190,68 +239,92 @@ class UsageService(BaseService):
             self.logger.error(f"Error getting usage stats for user {user_id}: {e}")
             raise
     
-    async def sync_usage_schedule(self):
-        """Scheduled task to sync Redis usage to database."""
+    async def sync_usage_schedule(self, batch_size: int = 500):
+        """Scheduled task to drain queued Redis usage counts into the database."""
         try:
-            # Get all usage keys from Redis
-            keys = await self.redis.client.keys("usage:*")
+            # Reset time (first day of next month)
+            _, reset_at, _ = _current_month_bounds()
             
             synced_count = 0
-            for key in keys:
+            while True:
+                entries = await self.redis.drain_usage_dirty(batch_size)
+                if not entries:
+                    break
+                
+                # Entries are "user_id:feature_name:count" in write order; the last one per feature wins
+                latest: Dict[Tuple[int, str], int] = {}
+                for entry in entries:
+                    try:
+                        user_part, rest = entry.split(":", 1)
+                        feature_name, count_part = rest.rsplit(":", 1)
+                        key = (int(user_part), feature_name)
+                        latest[key] = int(count_part)
+                    except ValueError:
+                        self.logger.error(f"Skipping malformed usage entry {entry}")
+                
+                rows = [
+                    (user_id, feature_name, usage_count, reset_at)
+                    for (user_id, feature_name), usage_count in latest.items()
+                ]
                 try:
-                    # Parse key: usage:user_id:feature_name
-                    parts = key.split(":")
-                    if len(parts) == 3:
-                        user_id = int(parts[1])
-                        feature_name = parts[2]
-                        current_usage = await self.redis.client.get(key)
-                        
-                        if current_usage:
-                            await self._sync_usage_to_db(user_id, feature_name, int(current_usage))
-                            synced_count += 1
-                            
-                except Exception as e:
-                    self.logger.error(f"Error syncing usage key {key}: {e}")
-                    continue
+                    synced_count += await self.usage_repo.bulk_upsert_usage(rows)
+                    await self.commit()
+                except Exception:
+                    await self.redis.requeue_usage_dirty(entries)
+                    raise
+                
+                if len(entries) < batch_size:
+                    break
             
             self.logger.info(f"Synced {synced_count} usage records to database")
             
         except Exception as e:
             self.logger.error(f"Error in usage sync schedule: {e}")
     
-    async def reset_expired_usage_schedule(self):
-        """Scheduled task to reset expired usage counters."""
-        try:
-            count = await self.usage_repo.reset_expired_usage()
-            
-            if count > 0:
-                self.logger.info(f"Reset {count} expired usage records")
-                
-                # Also clear corresponding Redis keys
-                # This is a simplified approach - in production you'd want more sophisticated cleanup
-                await self.redis.client.flushdb()  # Clear all Redis data
-                
-        except Exception as e:
-            self.logger.error(f"Error in expired usage reset schedule: {e}")
-    
-    async def _sync_usage_to_db(self, user_id: int, feature_name: str, current_usage: int):
-        """Sync current usage from Redis to database."""
+    async def sync_usage_to_database(
+        self,
+        user_id: int,
+        feature_name: str,
+        delta: int = 1,
+        reset_at: Optional[Any] = None
+    ) -> UserUsage:
+        """Apply a queued usage delta to the database counter atomically."""
         try:
-            # Calculate reset time (first day of next month)
-            now = datetime.utcnow()
-            reset_at = (now.replace(day=1) + timedelta(days=32)).replace(day=1)
-            
-            # Upsert usage record
-            await self.usage_repo.upsert_usage(
+            if reset_at is None:
+                _, reset_at, _ = _current_month_bounds()
+            elif isinstance(reset_at, str):
+                # Queue messages carry either an epoch string or an ISO timestamp
+                reset_at = (
+                    datetime.utcfromtimestamp(int(reset_at))
+                    if reset_at.isdigit()
+                    else datetime.fromisoformat(reset_at)
+                )
+            
+            usage = await self.usage_repo.increment_usage_atomic(
                 user_id=user_id,
                 feature_name=feature_name,
-                usage_count=current_usage,
+                delta=delta,
                 reset_at=reset_at
             )
+            await self.commit()
+            return usage
             
-            # Ensure changes are persisted for subsequent reads
-            await self.session.commit()
+        except Exception as e:
+            self.logger.error(f"Error applying usage delta for user {user_id}, feature {feature_name}: {e}")
+            raise
+    
+    async def reset_expired_usage_schedule(self):
+        """Scheduled task to reset expired usage counters."""
+        try:
+            reset_rows = await self.usage_repo.reset_expired_usage()
+            await self.commit()
             
+            if reset_rows:
+                self.logger.info(f"Reset {len(reset_rows)} expired usage records")
+                
+                # Also drop the matching Redis counters; nothing else in Redis is touched
+                cleared = await self.redis.reset_usage_counters(reset_rows)
+                self.logger.info(f"Cleared {cleared} Redis usage counters")
+                
         except Exception as e:
-            self.logger.error(f"Error syncing usage to DB: {e}")
-            # Don't raise here to avoid breaking the main usage flow 
\ No newline at end of file
+            self.logger.error(f"Error in expired usage reset schedule: {e}")
@@ -1,64 +1,92 @@
-from datetime import datetime
-from typing import Dict, Any, Optional
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional, Tuple, Union
 from uuid import UUID
-import json
 
-from app.models.subscription_event import SubscriptionEvent
+from cachetools import TTLCache
+from sqlalchemy.orm.attributes import set_committed_value
+
 from app.schemas.webhook import WebhookPayload, WebhookResponse
 from app.core.config import settings
+from app.core.redis_client import WEBHOOK_PROCESSING_QUEUE
 from .base_service import BaseService
 
 def serialize_payload(payload: WebhookPayload) -> Dict[str, Any]:
     """Convert webhook payload to JSON-serializable dict."""
-    payload_dict = payload.dict()
-    
-    # Convert UUIDs to strings
-    if isinstance(payload_dict.get('transaction_id'), UUID):
-        payload_dict['transaction_id'] = str(payload_dict['transaction_id'])
-    if isinstance(payload_dict.get('subscription_id'), UUID):
-        payload_dict['subscription_id'] = str(payload_dict['subscription_id'])
-    
-    # Convert datetime to ISO string
-    if isinstance(payload_dict.get('occurred_at'), datetime):
-        payload_dict['occurred_at'] = payload_dict['occurred_at'].isoformat()
-    
-    return payload_dict
+    # mode="json" emits UUIDs and datetimes as strings from pydantic's Rust serializer
+    return payload.model_dump(mode="json")
+
+
+def webhook_content_hash(payload: WebhookPayload) -> str:
+    """BLAKE2b-128 of the fields a webhook acts on (event_id and timestamps excluded)."""
+    raw = f"{payload.subscription_id}:{payload.transaction_id}:{payload.status}:{payload.amount}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
 
 
 class WebhookService(BaseService):
     """Service for handling webhook requests from payment service."""
     
+    # Event IDs and content hashes this process has already committed, so
+    # redeliveries are answered without a database round trip; the upsert
+    # stays authoritative
+    _processed_events: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+    
     async def process_payment_webhook(self, payload: WebhookPayload) -> WebhookResponse:
         """Process incoming payment webhook."""
+        content_hash = webhook_content_hash(payload)
+        if payload.event_id in self._processed_events or content_hash in self._processed_events:
+            self.logger.info(f"Webhook already processed", event_id=payload.event_id)
+            return WebhookResponse(
+                status="duplicate",
+                message="Event already processed",
+                event_id=payload.event_id
+            )
+        
         try:
-            # Check for duplicate webhook (idempotency)
-            existing_webhook = await self.webhook_repo.get_by_event_id(payload.event_id)
-            if existing_webhook:
-                if existing_webhook.is_processed:
-                    self.logger.info(f"Webhook already processed", event_id=payload.event_id)
-                    return WebhookResponse(
-                        status="duplicate",
-                        message="Event already processed",
-                        event_id=payload.event_id
-                    )
-                else:
-                    # Update existing unprocessed webhook
-                    await self.webhook_repo.update(existing_webhook.id, {
-                        "payload": serialize_payload(payload)
-                    })
-            else:
-                # Create new webhook request record
-                await self.webhook_repo.create_webhook_request(
-                    event_id=payload.event_id,
-                    payload=serialize_payload(payload)
+            payload_data = serialize_payload(payload)
+            
+            # Insert or refresh the webhook record; None means it (or the same
+            # content under another event_id) was already recorded
+            webhook_id = await self.webhook_repo.upsert_pending(payload.event_id, payload_data, content_hash)
+            if webhook_id is None:
+                self.logger.info(f"Webhook already processed", event_id=payload.event_id)
+                return WebhookResponse(
+                    status="duplicate",
+                    message="Event already processed",
+                    event_id=payload.event_id
                 )
             
-            # Synchronous processing by design (payment service does delivery retries)
-            processed = await self.process_webhook_event(payload.event_id, serialize_payload(payload))
+            if settings.WEBHOOK_ASYNC_PROCESSING:
+                # Persist the pending record, then leave the side effects to the
+                # webhook worker; a failed enqueue surfaces as an error so the
+                # payment service redelivers and the upsert re-arms the record
+                await self.commit()
+                await self.redis.queue_message(WEBHOOK_PROCESSING_QUEUE, {
+                    "event_id": payload.event_id,
+                    "payload": payload_data
+                })
+                return WebhookResponse(
+                    status="accepted",
+                    message="Webhook accepted for processing",
+                    event_id=payload.event_id
+                )
+            
+            # Synchronous processing (payment service does delivery retries);
+            # the payload is already typed, so skip the dict unwrapping of the worker path
+            processed = await self._apply_payment_event(
+                payload.event_id,
+                subscription_id=payload.subscription_id,
+                transaction_id=payload.transaction_id,
+                status=payload.status,
+                amount=payload.amount,
+                webhook_id=webhook_id
+            )
             if not processed:
                 raise RuntimeError("Webhook processing returned false")
             
-            await self.commit()
+            # _apply_payment_event committed the upsert and its effects together
+            self._processed_events[payload.event_id] = True
+            self._processed_events[content_hash] = True
             
             return WebhookResponse(
                 status="processed",
@@ -73,27 +101,59 @@ class WebhookService(BaseService):
     
     async def process_webhook_event(self, event_id: str, payload: Dict[str, Any]) -> bool:
         """Process webhook event (called by worker)."""
+        # payload dict may be the full message wrapper; unwrap if needed
+        actual = payload.get("payload", payload)
+        # IDs are passed through as decoded (UUID from msgspec, str from JSON
+        # queues); asyncpg encodes either form for uuid columns
+        subscription_id = actual.get("subscription_id")
+        transaction_id = actual.get("transaction_id")
+        if not subscription_id:
+            self.logger.error(f"Invalid webhook event payload: missing subscription_id", event_id=event_id)
+            return False
+        
+        # Queued events can be delivered more than once; never apply one twice
+        webhook = await self.webhook_repo.get_by_event_id(event_id)
+        if webhook and webhook.processed:
+            self.logger.info(f"Webhook already processed", event_id=event_id)
+            return True
+        
+        return await self._apply_payment_event(
+            event_id,
+            subscription_id=subscription_id,
+            transaction_id=transaction_id,
+            status=actual.get("status"),
+            amount=actual.get("amount", 0.0),
+            webhook_id=webhook.id if webhook else None
+        )
+    
+    async def _apply_payment_event(
+        self,
+        event_id: str,
+        subscription_id: Union[UUID, str],
+        transaction_id: Union[UUID, str],
+        status: str,
+        amount: float,
+        webhook_id: Optional[int] = None
+    ) -> bool:
+        """Apply a payment status to its subscription and mark the webhook processed."""
         try:
-            # payload dict may be the full message wrapper; unwrap if needed
-            actual = payload.get("payload", payload)
-            transaction_id = UUID(actual["transaction_id"]) if isinstance(actual.get("transaction_id"), str) else actual.get("transaction_id")
-            subscription_id = UUID(actual["subscription_id"]) if isinstance(actual.get("subscription_id"), str) else actual.get("subscription_id")
-            status = actual["status"]
-            amount = actual.get("amount", 0.0)
-            
             # Get subscription
-            subscription = await self.subscription_repo.get_with_relationships(subscription_id)
+            # Only the plan is read while applying the event; user/events stay unloaded
+            subscription = await self.subscription_repo.get_by_id(subscription_id, relationships=["plan"])
             if not subscription:
                 self.logger.error(f"Subscription not found for webhook", 
                                 subscription_id=str(subscription_id),
                                 event_id=event_id)
                 return False
             
+            # One timestamp for everything this event records
+            now = datetime.utcnow()
+            
             # Process based on payment status
             if status == "success":
-                await self._handle_payment_success(subscription, transaction_id, amount)
+                await self._handle_payment_success(subscription, transaction_id, amount, now)
             elif status == "failed":
-                await self._handle_payment_failure(subscription, transaction_id, amount)
+                await self._handle_payment_failure(subscription, transaction_id, amount, now)
             else:
                 self.logger.warning(f"Unknown payment status", 
                                   status=status,
@@ -101,11 +161,14 @@ class WebhookService(BaseService):
                 return False
             
             # Mark webhook as processed
-            webhook = await self.webhook_repo.get_by_event_id(event_id)
-            if webhook:
-                await self.webhook_repo.mark_processed(webhook.id)
+            if webhook_id is None:
+                webhook = await self.webhook_repo.get_by_event_id(event_id)
+                webhook_id = webhook.id if webhook else None
+            if webhook_id is not None:
+                await self.webhook_repo.mark_processed(webhook_id)
             
             await self.commit()
+            await self.redis.invalidate_active_sub(subscription.user_id)
             
             self.logger.info(f"Webhook event processed successfully",
                            event_id=event_id,
@@ -119,145 +182,140 @@ class WebhookService(BaseService):
             self.logger.error(f"Error processing webhook event: {e}")
             return False
     
-    async def _handle_payment_success(self, subscription, transaction_id: UUID, amount: float):
+    def _record_payment_event(
+        self,
+        subscription,
+        transaction_id: UUID,
+        outcome: Tuple[str, Dict[str, Any], Optional[int], Optional[int]],
+        now: datetime
+    ):
+        """Record the (event_type, metadata, old_plan_id, new_plan_id) a handler produced."""
+        event_type, metadata, old_plan_id, new_plan_id = outcome
+        self._record_event({
+            "subscription_id": subscription.id,
+            "event_type": event_type,
+            "transaction_id": transaction_id,
+            "old_plan_id": old_plan_id,
+            "new_plan_id": new_plan_id,
+            "effective_at": now,  # Effective immediately
+            "event_metadata": metadata
+        })
+    
+    async def _handle_payment_success(self, subscription, transaction_id: UUID, amount: float, now: datetime):
         """Handle successful payment."""
-        if subscription.status == "pending":
-            # If this is a trial plan, activate as 'trial'; otherwise activate as 'active'
-            new_status = "trial" if subscription.plan.is_trial_plan else "active"
-            await self.subscription_repo.update_status(subscription.id, new_status)
-            
-            # Create success event
-            event_data = {
-                "subscription_id": subscription.id,
-                "event_type": "payment_success",
-                "transaction_id": transaction_id,
-                "old_plan_id": None,  # No plan change
-                "new_plan_id": None,  # No plan change
-                "effective_at": datetime.utcnow(),  # Effective immediately
-                "event_metadata": {
-                    "amount": amount,
-                    "status_change": f"pending -> {new_status}"
-                }
-            }
-        
-        elif subscription.status == "past_due":
-            # Reactivate past due subscription
-            await self.subscription_repo.update_status(subscription.id, "active")
-            
-            # Create reactivation event
-            event_data = {
-                "subscription_id": subscription.id,
-                "event_type": "payment_success",
-                "transaction_id": transaction_id,
-                "old_plan_id": None,  # No plan change
-                "new_plan_id": None,  # No plan change
-                "effective_at": datetime.utcnow(),  # Effective immediately
-                "event_metadata": {
-                    "amount": amount,
-                    "status_change": "past_due -> active"
-                }
-            }
-        
-        elif subscription.status in ["active", "trial"]:
-            # Renewal payment
-            # Extend subscription dates
-            if subscription.plan.billing_cycle == "yearly":
-                subscription.extend_subscription()  # This adds 365 days
-            else:
-                subscription.extend_subscription(1)  # This adds 30 days
-            
-            await self.subscription_repo.update(subscription.id, {
-                "end_date": subscription.end_date
-            })
-            
-            # If on trial and there is a renewal plan configured, only switch plan on actual renewal (not initial trial activation)
-            if subscription.status == "active":
-                status_change = "active -> active (renewed)"
-                old_plan_id = None
-                new_plan_id = None
-            else:  # status == trial
-                renewal_plan = await self.plan_repo.get_renewal_plan(subscription.plan.id)
-                if renewal_plan:
-                    old_plan_id = subscription.plan.id  # Current trial plan
-                    new_plan_id = renewal_plan.id       # New basic/pro plan
-                    await self.subscription_repo.update(subscription.id, {"plan_id": renewal_plan.id, "status": "active"})
-                    status_change = f"trial -> active ({renewal_plan.name})"
-                else:
-                    old_plan_id = None
-                    new_plan_id = None
-                    status_change = "trial -> trial (extended)"
-            
-            # Create renewal event
-            event_data = {
-                "subscription_id": subscription.id,
-                "event_type": "renewed",
-                "transaction_id": transaction_id,
-                "old_plan_id": old_plan_id,
-                "new_plan_id": new_plan_id,
-                "effective_at": datetime.utcnow(),  # Effective immediately
-                "event_metadata": {
-                    "amount": amount,
-                    "new_end_date": subscription.end_date.isoformat(),
-                    "status_change": status_change
-                }
-            }
-        
-        else:
+        handler = self._SUCCESS_HANDLERS.get(subscription.status)
+        if handler is None:
             # Unexpected subscription status
             self.logger.warning(f"Payment success for unexpected subscription status",
                               subscription_id=str(subscription.id),
                               status=subscription.status)
             return
         
-        # Create the event
-        event = SubscriptionEvent(**event_data)
-        self.session.add(event)
+        outcome = await handler(self, subscription, amount)
+        self._record_payment_event(subscription, transaction_id, outcome, now)
     
-    async def _handle_payment_failure(self, subscription, transaction_id: UUID, amount: float):
-        """Handle failed payment."""
-        if subscription.status == "pending":
-            # Keep as pending, will be retried
-            event_type = "payment_failed"
-            metadata = {
-                "amount": amount,
-                "reason": "initial_payment_failed"
-            }
+    async def _success_from_pending(self, subscription, amount: float):
+        # If this is a trial plan, activate as 'trial'; otherwise activate as 'active'
+        new_status = "trial" if subscription.plan.is_trial_plan else "active"
+        await self.subscription_repo.update_status(subscription.id, new_status)
         
-        elif subscription.status in ["active", "trial"]:
-            # Mark as revoked on renewal failure
-            await self.subscription_repo.update_status(subscription.id, "revoked")
-            
-            event_type = "payment_failed"
-            metadata = {
-                "amount": amount,
-                "status_change": f"{subscription.status} -> revoked",
-                "reason": "renewal_payment_failed"
-            }
-            
-            # No retry for revoked in this testing flow
+        return "payment_success", {
+            "amount": amount,
+            "status_change": f"pending -> {new_status}"
+        }, None, None
+    
+    async def _success_from_past_due(self, subscription, amount: float):
+        # Reactivate past due subscription
+        await self.subscription_repo.update_status(subscription.id, "active")
         
-        else:
-            # Already past due or cancelled
-            event_type = "payment_failed"
-            metadata = {
-                "amount": amount,
-                "reason": "payment_failed_existing_status",
-                "current_status": subscription.status
-            }
+        return "payment_success", {
+            "amount": amount,
+            "status_change": "past_due -> active"
+        }, None, None
+    
+    async def _success_renewal(self, subscription, amount: float):
+        # Renewal payment: extend subscription dates. Computed here rather than via
+        # extend_subscription() so the tracked instance is not dirtied into a
+        # second UPDATE at commit
+        extension = timedelta(days=365 if subscription.plan.billing_cycle == "yearly" else 30)
+        new_end_date = subscription.end_date + extension
         
-        # Create failure event
-        event_data = {
-            "subscription_id": subscription.id,
-            "event_type": event_type,
-            "transaction_id": transaction_id,
-            "old_plan_id": None,  # No plan change
-            "new_plan_id": None,  # No plan change
-            "effective_at": datetime.utcnow(),  # Effective immediately
-            "event_metadata": metadata
+        # If on trial and there is a renewal plan configured, only switch plan on actual renewal (not initial trial activation)
+        old_plan_id = new_plan_id = None
+        renewal = None
+        if subscription.status == "active":
+            status_change = "active -> active (renewed)"
+        else:  # status == trial
+            # Switch plan, activate and extend in one UPDATE ... FROM
+            renewal = await self.subscription_repo.switch_to_renewal_plan(
+                subscription.id, status="active", end_date=new_end_date
+            )
+            if renewal:
+                old_plan_id = subscription.plan.id  # Current trial plan
+                new_plan_id, _, renewal_plan_name = renewal  # New basic/pro plan
+                status_change = f"trial -> active ({renewal_plan_name})"
+                # Mirror the UPDATE on the loaded instance without marking it dirty
+                set_committed_value(subscription, "status", "active")
+                set_committed_value(subscription, "plan_id", new_plan_id)
+            else:
+                status_change = "trial -> trial (extended)"
+        
+        if not renewal:
+            await self.subscription_repo.update(subscription.id, {
+                "end_date": new_end_date
+            })
+        set_committed_value(subscription, "end_date", new_end_date)
+        
+        return "renewed", {
+            "amount": amount,
+            "new_end_ts": int(new_end_date.replace(tzinfo=timezone.utc).timestamp()),
+            "status_change": status_change
+        }, old_plan_id, new_plan_id
+    
+    _SUCCESS_HANDLERS = {
+        "pending": _success_from_pending,
+        "past_due": _success_from_past_due,
+        "active": _success_renewal,
+        "trial": _success_renewal,
+    }
+    
+    async def _handle_payment_failure(self, subscription, transaction_id: UUID, amount: float, now: datetime):
+        """Handle failed payment."""
+        handler = self._FAILURE_HANDLERS.get(subscription.status, WebhookService._failure_existing_status)
+        metadata = await handler(self, subscription, amount)
+        # Failures never change the plan
+        self._record_payment_event(subscription, transaction_id, ("payment_failed", metadata, None, None), now)
+    
+    async def _failure_from_pending(self, subscription, amount: float):
+        # Keep as pending, will be retried
+        return {
+            "amount": amount,
+            "reason": "initial_payment_failed"
         }
+    
+    async def _failure_renewal(self, subscription, amount: float):
+        # Mark as revoked on renewal failure; no retry for revoked in this testing flow
+        await self.subscription_repo.update_status(subscription.id, "revoked")
         
-        event = SubscriptionEvent(**event_data)
-        self.session.add(event)
+        return {
+            "amount": amount,
+            "status_change": f"{subscription.status} -> revoked",
+            "reason": "renewal_payment_failed"
+        }
+    
+    async def _failure_existing_status(self, subscription, amount: float):
+        # Already past due or cancelled
+        return {
+            "amount": amount,
+            "reason": "payment_failed_existing_status",
+            "current_status": subscription.status
+        }
+    
+    _FAILURE_HANDLERS = {
+        "pending": _failure_from_pending,
+        "active": _failure_renewal,
+        "trial": _failure_renewal,
+    }
     
     async def get_webhook_status(self, event_id: str) -> Optional[Dict[str, Any]]:
         """Get webhook processing status."""
@@ -1,12 +1,15 @@
-import json
 import asyncio
-from typing import Dict, Any, Optional
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
+import orjson
+import uvloop
 
 from app.core.database import get_async_session
 from app.core.redis_client import redis_client
 from app.core.logging import get_logger
 from app.core.config import settings
+from app.schemas.queue_msgs import FailedMsg
 
 
 class BaseConsumer:
@@ -56,13 +59,13 @@ class BaseConsumer:
                               delay=delay,
                               error=str(error))
         else:
-            # Move to failed queue
-            failed_message = {
-                **message_data,
-                "failed_at": "2024-01-01T00:00:00Z",  # Would use datetime.utcnow()
-                "error_message": str(error),
-                "original_queue": self.queue_name
-            }
+            # Move to failed queue, wrapping the original message instead of copying it
+            failed_message = FailedMsg(
+                original=message_data,
+                failed_at=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                error_message=str(error),
+                original_queue=self.queue_name
+            )
             
             await self.redis.queue_message(f"{self.queue_name}:failed", failed_message)
             
@@ -70,40 +73,89 @@ class BaseConsumer:
                             retry_count=retry_count,
                             error=str(error))
     
+    @staticmethod
+    def ordering_key(message_data: Dict[str, Any]) -> Optional[str]:
+        """Key whose messages must be processed in order (None means unordered)."""
+        key = message_data.get("subscription_id") or message_data.get("user_id")
+        return str(key) if key is not None else None
+    
+    async def _process_one(self, message_data: Dict[str, Any]):
+        """Process one message, routing failures to the retry logic."""
+        try:
+            # Process the message
+            success = await self.process_message(message_data)
+            
+            if success:
+                self.logger.debug(f"Message processed successfully",
+                                queue=self.queue_name)
+            else:
+                # Processing failed, handle retry
+                await self.handle_retry(message_data, Exception("Processing failed"))
+        
+        except Exception as e:
+            self.logger.error(f"Error processing message: {e}",
+                            queue=self.queue_name,
+                            message=message_data)
+            
+            # Handle retry for processing errors
+            await self.handle_retry(message_data, e)
+    
+    async def _process_in_order(self, messages: List[Dict[str, Any]]):
+        """Process messages sharing an ordering key one after another."""
+        for message_data in messages:
+            await self._process_one(message_data)
+    
+    async def process_batch(self, raw_messages: List[str]):
+        """
+        Process a popped batch concurrently.
+        
+        Messages with the same ordering key (subscription or user) run
+        sequentially in pop order; different keys overlap their DB work.
+        """
+        groups: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        tasks = []
+        for message_str in raw_messages:
+            try:
+                message_data = orjson.loads(message_str)
+            except orjson.JSONDecodeError as e:
+                self.logger.error(f"Dropping undecodable message: {e}", queue=self.queue_name)
+                continue
+            
+            key = self.ordering_key(message_data)
+            if key is None:
+                tasks.append(self._process_one(message_data))
+            else:
+                groups.setdefault(key, []).append(message_data)
+        
+        tasks.extend(self._process_in_order(group) for group in groups.values())
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error(f"Error in message batch: {result}", queue=self.queue_name)
+    
     async def run_consumer(self):
         """Main consumer loop."""
         self.logger.info(f"Starting consumer for queue: {self.queue_name}")
         
+        if not self.redis.client:
+            await self.redis.connect()
+        
         while True:
             try:
-                # Use blocking pop with timeout
-                result = await self.redis.client.brpop(self.queue_name, timeout=10)
+                # Pop up to a batch per round trip (Redis 7 BLMPOP), blocking when empty
+                result = await self.redis.client.blmpop(
+                    settings.QUEUE_TIMEOUT,
+                    1,
+                    self.queue_name,
+                    direction="RIGHT",
+                    count=settings.CONSUMER_BATCH_SIZE
+                )
                 
                 if not result:
                     continue  # Timeout, continue loop
                 
-                # Parse message
-                queue, message_str = result
-                message_data = json.loads(message_str)
-                
-                try:
-                    # Process the message
-                    success = await self.process_message(message_data)
-                    
-                    if success:
-                        self.logger.debug(f"Message processed successfully",
-                                        queue=self.queue_name)
-                    else:
-                        # Processing failed, handle retry
-                        await self.handle_retry(message_data, Exception("Processing failed"))
-                
-                except Exception as e:
-                    self.logger.error(f"Error processing message: {e}",
-                                    queue=self.queue_name,
-                                    message=message_data)
-                    
-                    # Handle retry for processing errors
-                    await self.handle_retry(message_data, e)
+                queue, messages = result
+                await self.process_batch(messages)
             
             except Exception as e:
                 self.logger.error(f"Error in consumer loop: {e}")
@@ -111,4 +163,6 @@ class BaseConsumer:
     
     def run_sync_consumer(self):
         """Synchronous wrapper for async consumer (for Celery)."""
+        # Same libuv loop the API runs under (uvicorn --loop uvloop)
+        uvloop.install()
         asyncio.run(self.run_consumer()) 
\ No newline at end of file
@@ -1,7 +1,25 @@
+import asyncio
+from typing import Any, Coroutine, Optional
+
+import orjson
+import uvloop
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init
+from kombu.serialization import register
 
 from app.core.config import settings
+from app.core.redis_client import redis_client
+
+# orjson-backed JSON for task messages and results; same wire format as
+# Celery's json serializer, without the stdlib encoder on every enqueue
+register(
+    'orjson',
+    orjson.dumps,
+    orjson.loads,
+    content_type='application/x-orjson',
+    content_encoding='utf-8'
+)
 
 # Create Celery instance
 celery_app = Celery(
@@ -19,9 +37,11 @@ celery_app = Celery(
 # Configure Celery
 celery_app.conf.update(
     # Task serialization
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
+    task_serializer='orjson',
+    # Keep json so messages enqueued before the switch still run
+    accept_content=['orjson', 'json'],
+    result_serializer='orjson',
+    result_accept_content=['orjson', 'json'],
     timezone='UTC',
     enable_utc=True,
     
@@ -35,32 +55,27 @@ celery_app.conf.update(
     
     # Worker configuration
     worker_concurrency=4,
-    worker_prefetch_multiplier=1,
+    # Short tasks dominate, so reserve several per fetch; the slow HTTP-bound
+    # tasks opt into redelivery if a worker dies while holding them
+    worker_prefetch_multiplier=settings.CELERY_PREFETCH_MULTIPLIER,
     task_acks_late=True,
     
     # Beat schedule for periodic tasks
     beat_schedule={
-        # Process Redis queues every 10 seconds
-        "process-payment-initiation-queue": {
-            "task": "app.workers.queue_processor.poll_payment_initiation_queue",
-            "schedule": 10.0,  # Every 10 seconds
-        },
-        "process-trial-payment-queue": {
-            "task": "app.workers.queue_processor.poll_trial_payment_queue", 
+        # Process Redis queues every 10 seconds; the four q:sub:* queues are
+        # claimed together in one pipelined round trip
+        "process-sub-queues": {
+            "task": "app.workers.queue_processor.poll_all_sub_queues",
             "schedule": 10.0,  # Every 10 seconds
         },
-        "process-plan-change-queue": {
-            "task": "app.workers.queue_processor.poll_plan_change_queue",
-            "schedule": 10.0,  # Every 10 seconds
-        },
-        "process-usage-sync-queue": {
-            "task": "app.workers.queue_processor.poll_usage_sync_queue",
-            "schedule": 15.0,  # Every 15 seconds
-        },
         "process-webhook-queue": {
             "task": "app.workers.queue_processor.poll_webhook_processing_queue",
             "schedule": 10.0,  # Every 10 seconds
         },
+        "process-webhook-task-queue": {
+            "task": "app.workers.queue_processor.poll_webhook_task_queue",
+            "schedule": 5.0,  # Every 5 seconds; idle unless WEBHOOK_ASYNC_PROCESSING
+        },
         
         # Pump delayed queues frequently
         "pump-delayed-queues": {
@@ -73,9 +88,13 @@ celery_app.conf.update(
             "task": "app.workers.subscription_consumer.schedule_renewals",
             "schedule": crontab(hour=1, minute=0),  # Daily at 1 AM
         },
+        "subscription-event-outbox": {
+            "task": "app.workers.subscription_consumer.flush_subscription_event_outbox",
+            "schedule": 15.0,  # Every 15 seconds; no-op unless SUBSCRIPTION_EVENT_OUTBOX
+        },
         "usage-sync-scheduler": {
             "task": "app.workers.usage_consumer.sync_usage_to_database",
-            "schedule": crontab(minute="*/15"),  # Every 15 minutes
+            "schedule": 60.0,  # Every minute; drains usage:dirty
         },
         "usage-reset-scheduler": {
             "task": "app.workers.usage_consumer.reset_expired_usage",
@@ -96,5 +115,33 @@ celery_app.conf.update(
     },
 )
 
+if settings.WEBHOOK_LONG_POLL_CONSUMER:
+    # A dedicated consumer process blocks on the webhook task queue instead
+    celery_app.conf.beat_schedule.pop("process-webhook-task-queue", None)
+
+# One event loop per worker process, reused by every task: no per-task loop
+# setup/teardown, and pooled Redis/asyncpg connections stay on the loop
+# that opened them
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+@worker_process_init.connect
+def _init_worker_loop(**kwargs):
+    global _LOOP
+    _LOOP = uvloop.new_event_loop()
+    asyncio.set_event_loop(_LOOP)
+    _LOOP.run_until_complete(redis_client.connect())
+
+
+def run_async(coro: Coroutine[Any, Any, Any]) -> Any:
+    """Run a coroutine to completion on this worker process's persistent loop."""
+    global _LOOP
+    if _LOOP is None or _LOOP.is_closed():
+        # Pools without worker_process_init (solo/threads) and eager calls
+        _LOOP = uvloop.new_event_loop()
+        asyncio.set_event_loop(_LOOP)
+    return _LOOP.run_until_complete(coro)
+
+
 # Import tasks to register them
 from app.workers import subscription_consumer, usage_consumer, webhook_consumer, queue_processor 
\ No newline at end of file
@@ -1,12 +1,15 @@
-import asyncio
+import hashlib
 import json
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
-from .celery_app import celery_app
+import msgspec
+import orjson
+
+from .celery_app import celery_app, run_async
 from .base_consumer import BaseConsumer
 from app.core.database import AsyncSessionLocal
-from app.core.redis_client import redis_client
+from app.core.redis_client import redis_client, WEBHOOK_PROCESSING_QUEUE
 from app.core.logging import get_logger
 from app.core.queue_policies import QUEUE_POLICIES
 
@@ -42,14 +45,15 @@ class QueueProcessorConsumer(BaseConsumer):
             if not redis_client.client:
                 await redis_client.connect()
             
-            # Move ready delayed → main for all sub queues
-            for main in [
+            # Move ready delayed → main for all sub queues in one round trip
+            moved_counts = await redis_client.move_ready_delayed_batch([
                 "q:sub:payment_initiation",
                 "q:sub:trial_payment",
                 "q:sub:plan_change",
                 "q:sub:usage_sync",
-            ]:
-                moved = await redis_client.move_ready_delayed_to_main(main)
+                WEBHOOK_PROCESSING_QUEUE,
+            ])
+            for main, moved in moved_counts.items():
                 if moved:
                     logger.info(f"Moved {moved} delayed messages to {main}")
         except Exception as e:
@@ -71,14 +75,18 @@ class QueueProcessorConsumer(BaseConsumer):
                 "q:sub:plan_change:failed"
             ]
             
+            # Read every failed queue's length in one round trip
+            pipe = redis_client.client.pipeline(transaction=False)
             for queue in failed_queues:
+                pipe.llen(queue)
+            lengths = await pipe.execute()
+            
+            for queue, current_length in zip(failed_queues, lengths):
                 # Remove old messages from failed queues
                 # This is a simplified cleanup - in production you'd want more sophisticated logic
-                current_length = await redis_client.get_queue_length(queue)
                 if current_length > 1000:  # If too many failed messages
-                    # Keep only the latest 100
-                    for _ in range(current_length - 100):
-                        await redis_client.client.rpop(queue)
+                    # Keep only the latest 100 (failures are LPUSHed, newest at the head)
+                    await redis_client.client.ltrim(queue, 0, 99)
                     
                     logger.info(f"Cleaned up old messages from {queue}")
             
@@ -98,26 +106,42 @@ async def _compute_backoff(queue_name: str, attempts: int) -> int:
     return max(0, delay + random.randint(0, jitter))
 
 
-async def _claim_lock_process(queue_main: str, handler_task, action_label: str):
+def _msg_key(msg: str) -> str:
+    """Deterministic lock-key suffix for an id-less message; matches redis.sha1hex in CLAIM_AND_LOCK_LUA."""
+    return hashlib.sha1(msg.encode("utf-8")).hexdigest()
+
+
+def _lock_ttl(queue_main: str) -> int:
+    return getattr(QUEUE_POLICIES.get(queue_main, object()), 'lock_ttl_seconds', 120) or 120
+
+
+async def _claim_lock_process(queue_main: str, handler_task, action_label: str, claimed: Optional[List[str]] = None):
+    """
+    Hand a claimed, locked message to its handler.
+    
+    Claims one itself (atomic claim_and_lock) unless ``claimed`` is the
+    result of a batched claim.
+    """
     queue_processing = f"{queue_main}:processing"
-    msg = await redis_client.claim_message(queue_main, queue_processing, timeout=1)
-    if not msg:
+    if claimed is None:
+        claimed = await redis_client.claim_and_lock(queue_main, _lock_ttl(queue_main))
+    if not claimed:
         return "no_message"
+    if claimed[0] == "locked":
+        # The script already put the message back on the main queue
+        return "retry"
+    _, msg, lock_key = claimed
     try:
         raw = json.loads(msg)
     except Exception:
         raw = msg
     attempts = int((raw or {}).get("attempts", 0) if isinstance(raw, dict) else 0)
-    lock_ttl = getattr(QUEUE_POLICIES.get(queue_main, object()), 'lock_ttl_seconds', 120)
-    lock_key = f"lock:{queue_main}:{hash(msg)}"
-    got = await redis_client.set_lock(lock_key, ttl_seconds=lock_ttl or 120)
-    if not got:
-        await redis_client.remove_from_processing(queue_processing, msg)
-        await redis_client.queue_message(queue_main, raw if isinstance(raw, dict) else {"payload": raw})
-        return "retry"
     try:
-        # Delegate to specific handler
-        return await handler_task(msg)
+        # Delegate to specific handler; once it succeeds the message is done
+        # and must not linger for the sweeper to redeliver
+        result = await handler_task(msg)
+        await redis_client.remove_from_processing(queue_processing, msg)
+        return result
     except Exception as e:
         attempts_next = attempts + 1
         max_retries = getattr(QUEUE_POLICIES.get(queue_main, object()), 'max_retries', 5)
@@ -138,73 +162,111 @@ async def _claim_lock_process(queue_main: str, handler_task, action_label: str):
         await redis_client.release_lock(lock_key)
 
 
+async def retry_webhook_task(message: Dict[str, Any], message_json: Optional[str] = None):
+    """
+    Retry or fail a webhook task that was not applied.
+    
+    Shared by poll_webhook_task_queue and WebhookConsumer so the queue has
+    one contract: ``attempts`` against the queue policy's max_retries with
+    _compute_backoff delays, then the raw task LPUSHed to ``:failed``.
+    """
+    queue_name = WEBHOOK_PROCESSING_QUEUE
+    attempts = int(message.get("attempts", 0)) + 1
+    max_retries = getattr(QUEUE_POLICIES.get(queue_name, object()), 'max_retries', 5)
+    if attempts <= max_retries:
+        await redis_client.queue_delayed_message(
+            queue_name, {**message, "attempts": attempts},
+            delay_seconds=await _compute_backoff(queue_name, attempts)
+        )
+    else:
+        if message_json is None:
+            message_json = orjson.dumps(message).decode()
+        await redis_client.client.lpush(f"{queue_name}:failed", message_json)
+
+
+# Subscription work queues claimed together by poll_all_sub_queues
+SUB_QUEUES = (
+    "q:sub:payment_initiation",
+    "q:sub:trial_payment",
+    "q:sub:plan_change",
+    "q:sub:usage_sync",
+)
+
+
+def _sub_queue_handlers() -> Dict[str, Any]:
+    """
+    Map each sub queue to its processing coroutine.
+    
+    Claimed messages are processed in-process while their lock is held,
+    instead of being re-published to the Celery broker; a raised error
+    goes through the queue's delayed-retry policy.
+    """
+    from .subscription_consumer import (
+        process_payment_initiation_async,
+        process_trial_payment_async,
+        process_plan_change_async,
+    )
+    from .usage_consumer import process_usage_sync_async
+    
+    return {
+        "q:sub:payment_initiation": process_payment_initiation_async,
+        "q:sub:trial_payment": process_trial_payment_async,
+        "q:sub:plan_change": process_plan_change_async,
+        "q:sub:usage_sync": process_usage_sync_async,
+    }
+
+
+@celery_app.task(bind=True)
+def poll_all_sub_queues(self):
+    """Claim one message from every sub queue in a single pipelined round trip."""
+    async def _run():
+        if not redis_client.client:
+            await redis_client.connect()
+        
+        # Atomic claim (main -> :processing) + lock per queue, one pipelined round trip
+        claimed = await redis_client.claim_and_lock_batch({queue: _lock_ttl(queue) for queue in SUB_QUEUES})
+        
+        handlers = _sub_queue_handlers()
+        results = {}
+        for queue in SUB_QUEUES:
+            if not claimed.get(queue):
+                results[queue] = "no_message"
+                continue
+            results[queue] = await _claim_lock_process(queue, handlers[queue], queue.rsplit(":", 1)[-1], claimed=claimed[queue])
+        return results
+    return run_async(_run())
+
+
 @celery_app.task(bind=True)
 def poll_payment_initiation_queue(self):
-    """BRPOPLPUSH + lock wrapper for payment initiation."""
+    """Claim + lock + process wrapper for payment initiation."""
     async def _run():
-        from .subscription_consumer import process_payment_initiation
-        async def handler(message_json: str):
-            # hand off to existing task
-            process_payment_initiation.apply_async(args=[message_json])
-            return "dispatched"
-        return await _claim_lock_process("q:sub:payment_initiation", handler, "payment_initiation")
-    try:
-        return asyncio.run(_run())
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(_run())
+        return await _claim_lock_process("q:sub:payment_initiation", _sub_queue_handlers()["q:sub:payment_initiation"], "payment_initiation")
+    return run_async(_run())
 
 
 @celery_app.task(bind=True)
 def poll_trial_payment_queue(self):
-    """BRPOPLPUSH + lock wrapper for trial payment."""
+    """Claim + lock + process wrapper for trial payment."""
     async def _run():
-        from .subscription_consumer import process_trial_payment
-        async def handler(message_json: str):
-            process_trial_payment.apply_async(args=[message_json])
-            return "dispatched"
-        return await _claim_lock_process("q:sub:trial_payment", handler, "trial_payment")
-    try:
-        return asyncio.run(_run())
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(_run())
+        return await _claim_lock_process("q:sub:trial_payment", _sub_queue_handlers()["q:sub:trial_payment"], "trial_payment")
+    return run_async(_run())
 
 
 @celery_app.task(bind=True)
 def poll_plan_change_queue(self):
-    """BRPOPLPUSH + lock wrapper for plan change."""
+    """Claim + lock + process wrapper for plan change."""
     async def _run():
-        from .subscription_consumer import process_plan_change
-        async def handler(message_json: str):
-            process_plan_change.apply_async(args=[message_json])
-            return "dispatched"
-        return await _claim_lock_process("q:sub:plan_change", handler, "plan_change")
-    try:
-        return asyncio.run(_run())
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(_run())
+        return await _claim_lock_process("q:sub:plan_change", _sub_queue_handlers()["q:sub:plan_change"], "plan_change")
+    return run_async(_run())
 
 
 @celery_app.task(bind=True)
 def poll_usage_sync_queue(self):
-    """BRPOPLPUSH + lock wrapper for usage sync."""
+    """Claim + lock + process wrapper for usage sync."""
     async def _run():
-        from .usage_consumer import process_usage_sync
-        async def handler(message_json: str):
-            process_usage_sync.apply_async(args=[message_json])
-            return "dispatched"
-        return await _claim_lock_process("q:sub:usage_sync", handler, "usage_sync")
-    try:
-        return asyncio.run(_run())
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(_run())
+        return await _claim_lock_process("q:sub:usage_sync", _sub_queue_handlers()["q:sub:usage_sync"], "usage_sync")
+    return run_async(_run())
 
 
 @celery_app.task(bind=True)
@@ -215,7 +277,7 @@ def process_delayed_queues():
             processor = QueueProcessorConsumer(None)
             await processor._process_delayed_queues()
         
-        asyncio.run(run_processing())
+        run_async(run_processing())
         logger.info("Delayed queue processing completed")
         
     except Exception as e:
@@ -231,7 +293,7 @@ def cleanup_old_queue_messages():
             processor = QueueProcessorConsumer(None)
             await processor._cleanup_old_messages()
         
-        asyncio.run(run_cleanup())
+        run_async(run_cleanup())
         logger.info("Queue cleanup completed")
         
     except Exception as e:
@@ -254,7 +316,8 @@ def monitor_queue_health():
                 "q:sub:payment_initiation",
                 "q:sub:trial_payment",
                 "q:sub:plan_change",
-                "q:sub:usage_sync"
+                "q:sub:usage_sync",
+                WEBHOOK_PROCESSING_QUEUE
             ]
             
             for queue in queues_to_monitor:
@@ -265,7 +328,7 @@ def monitor_queue_health():
             
             logger.info("Queue health monitoring completed")
         
-        asyncio.run(run_monitoring())
+        run_async(run_monitoring())
         
     except Exception as e:
         logger.error(f"Queue health monitoring failed: {e}")
@@ -295,7 +358,8 @@ def sweep_processing_queues(self):
                         raw = json.loads(msg)
                     except Exception:
                         raw = {}
-                    mid = (raw.get("id") if isinstance(raw, dict) else None) or str(hash(msg))
+                    # Same lock key claim_and_lock takes: envelope id, else sha1 of the message
+                    mid = (raw.get("id") if isinstance(raw, dict) else None) or _msg_key(msg)
                     lock_key = f"lock:{main}:{mid}"
                     lock_exists = await redis_client.client.exists(lock_key)
                     if lock_exists:
@@ -317,7 +381,7 @@ def sweep_processing_queues(self):
                 results[main] = swept
             logger.info(f"Processing sweeper results: {results}")
         
-        asyncio.run(_run())
+        run_async(_run())
     except Exception as e:
         logger.error(f"Visibility sweep failed: {e}")
         raise
@@ -338,47 +402,98 @@ def poll_webhook_processing_queue(self):
             message_data = await redis_client.client.brpop(queue_name, timeout=1)
             if message_data:
                 queue_name_returned, message_json = message_data
-                message = json.loads(message_json)
-                logger.info(f"Processing webhook from queue: {message}")
+                logger.info(f"Processing webhook from queue: {message_json}")
                 
                 # Import here to avoid circular dependencies
                 from app.services.webhook_service import WebhookService
-                from app.schemas.webhook import WebhookPayload
+                from app.schemas.webhook import WebhookPayloadMsg
                 
                 async with AsyncSessionLocal() as session:
                     try:
                         webhook_service = WebhookService(session)
                         
-                        # Convert message to webhook payload
-                        webhook_payload = WebhookPayload(**message)
+                        # Parse and validate the message in a single msgspec decode
+                        webhook_payload = msgspec.json.decode(message_json, type=WebhookPayloadMsg)
                         
                         # Process the webhook
                         result = await webhook_service.process_webhook_event(
                             webhook_payload.event_id, 
-                            message
+                            msgspec.structs.asdict(webhook_payload)
                         )
                         
                         logger.info(f"Webhook processing result: {result}")
                         
                     except Exception as e:
                         logger.error(f"Error processing webhook message: {e}")
-                        # Re-queue for retry
-                        await redis_client.queue_message(queue_name, message)
+                        # Re-queue the original JSON for retry
+                        await redis_client.queue_raw(queue_name, message_json)
             else:
                 logger.debug("No webhook messages to process")
         
-        # Handle asyncio event loop properly in Celery worker
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        loop.run_until_complete(run_webhook_processing())
+        run_async(run_webhook_processing())
         
     except Exception as e:
         logger.error(f"Webhook processing polling failed: {e}")
-        raise 
\ No newline at end of file
+        raise 
+
+@celery_app.task(bind=True)
+def poll_webhook_task_queue(self):
+    """Apply payment webhooks recorded by the API (WEBHOOK_ASYNC_PROCESSING)."""
+    async def _run():
+        if not redis_client.client:
+            await redis_client.connect()
+        
+        from app.core.config import settings
+        from app.services.webhook_service import WebhookService
+        
+        queue_name = WEBHOOK_PROCESSING_QUEUE
+        processed = 0
+        while processed < settings.CONSUMER_BATCH_SIZE:
+            popped = await redis_client.client.brpop(queue_name, timeout=1)
+            if not popped:
+                break
+            _, message_json = popped
+            
+            try:
+                message = orjson.loads(message_json)
+                event_id = message["event_id"]
+                subscription_id = message["payload"]["subscription_id"]
+            except Exception as e:
+                logger.error(f"Dropping malformed webhook task: {e}")
+                await redis_client.client.lpush(f"{queue_name}:failed", message_json)
+                continue
+            
+            # Events for one subscription are applied one at a time across workers
+            lock_key = f"lock:subscription:{subscription_id}"
+            lock_ttl = getattr(QUEUE_POLICIES.get(queue_name, object()), 'lock_ttl_seconds', 120) or 120
+            if not await redis_client.set_lock(lock_key, ttl_seconds=lock_ttl):
+                # Put it back at the consuming end and yield to the lock holder
+                await redis_client.client.rpush(queue_name, message_json)
+                break
+            
+            try:
+                async with AsyncSessionLocal() as session:
+                    ok = await WebhookService(session).process_webhook_event(event_id, message)
+            except Exception as e:
+                logger.error(f"Error processing webhook task: {e}", event_id=event_id)
+                ok = False
+            finally:
+                await redis_client.release_lock(lock_key)
+            
+            if not ok:
+                await retry_webhook_task(message, message_json)
+            processed += 1
+        
+        if processed and settings.SUBSCRIPTION_EVENT_OUTBOX:
+            # Each event above was only buffered; land the batch's events in one
+            # multi-row insert now rather than waiting for the outbox beat
+            from app.services.subscription_service import SubscriptionService
+            try:
+                async with AsyncSessionLocal() as session:
+                    await SubscriptionService(session).flush_event_outbox()
+            except Exception as e:
+                # Entries were requeued; the scheduled flush will retry them
+                logger.error(f"Error flushing subscription events after webhook batch: {e}")
+        
+        return processed
+    return run_async(_run())
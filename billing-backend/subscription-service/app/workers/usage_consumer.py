@@ -1,8 +1,7 @@
-import asyncio
 import json
 from typing import Dict, Any
 
-from .celery_app import celery_app
+from .celery_app import celery_app, run_async
 from .base_consumer import BaseConsumer
 from app.core.database import AsyncSessionLocal
 from app.services.usage_service import UsageService
@@ -38,29 +37,33 @@ class UsageConsumer(BaseConsumer):
             return False
 
 
+async def process_usage_sync_async(message_data: str) -> Dict[str, Any]:
+    """Handle a queued usage sync message."""
+    message = json.loads(message_data)
+    logger.info(f"Processing usage sync: {message}")
+    
+    user_id = message.get("user_id")
+    feature_name = message.get("feature_name")
+    delta = message.get("delta", 1)
+    
+    logger.info(f"Usage sync for user {user_id}, feature {feature_name}, delta {delta}")
+    
+    # Simulate processing - in real implementation this would sync Redis to DB
+    return {"status": "synced", "user_id": user_id, "feature": feature_name}
+
+
 @celery_app.task(bind=True, max_retries=3)
 def process_usage_sync(self, message_data: str):
     """Process usage sync queue messages."""
     try:
-        message = json.loads(message_data)
-        logger.info(f"Processing usage sync: {message}")
-        
-        user_id = message.get("user_id")
-        feature_name = message.get("feature_name")
-        delta = message.get("delta", 1)
-        
-        logger.info(f"Usage sync for user {user_id}, feature {feature_name}, delta {delta}")
-        
-        # Simulate processing - in real implementation this would sync Redis to DB
-        return {"status": "synced", "user_id": user_id, "feature": feature_name}
-        
+        return run_async(process_usage_sync_async(message_data))
     except Exception as e:
         logger.error(f"Usage sync failed: {e}")
         raise self.retry(countdown=60, exc=e)
 
 
 @celery_app.task(bind=True)
-def sync_usage_to_database():
+def sync_usage_to_database(self):
     """Scheduled task to sync Redis usage data to database."""
     try:
         async def run_sync():
@@ -68,7 +71,7 @@ def sync_usage_to_database():
                 service = UsageService(session)
                 await service.sync_usage_schedule()
         
-        asyncio.run(run_sync())
+        run_async(run_sync())
         logger.info("Usage sync to database completed")
         
     except Exception as e:
@@ -85,7 +88,7 @@ def reset_expired_usage():
                 service = UsageService(session)
                 await service.reset_expired_usage_schedule()
         
-        asyncio.run(run_reset())
+        run_async(run_reset())
         logger.info("Expired usage reset completed")
         
     except Exception as e:
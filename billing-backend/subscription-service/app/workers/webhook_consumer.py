@@ -1,12 +1,17 @@
 import asyncio
 import json
-from typing import Dict, Any
+import time
+from typing import Dict, Any, List, Optional
 
-from .celery_app import celery_app
+from .celery_app import celery_app, run_async
 from .base_consumer import BaseConsumer
+from .queue_processor import retry_webhook_task
+from app.core.config import settings
 from app.core.database import AsyncSessionLocal
+from app.core.queue_policies import QUEUE_POLICIES
 from app.services.webhook_service import WebhookService
 from app.core.logging import get_logger
+from app.core.redis_client import WEBHOOK_PROCESSING_QUEUE
 
 logger = get_logger(__name__)
 
@@ -14,25 +19,75 @@ logger = get_logger(__name__)
 class WebhookConsumer(BaseConsumer):
     """Consumer for webhook-related tasks."""
     
+    # How often a message waits on a subscription lock held by another worker
+    LOCK_RETRY_INTERVAL = 0.05
+    # Longest wait for that lock in seconds; None waits up to the queue's lock TTL
+    LOCK_WAIT: Optional[float] = None
+    
+    @staticmethod
+    def ordering_key(message_data: Dict[str, Any]) -> Optional[str]:
+        """Webhook tasks carry the subscription under payload; order per subscription."""
+        payload = message_data.get("payload")
+        key = (payload.get("subscription_id") if isinstance(payload, dict) else None) \
+            or message_data.get("subscription_id")
+        return str(key) if key is not None else None
+    
+    async def _acquire_subscription_lock(self, lock_key: str) -> bool:
+        """Wait for the per-subscription lock that poll_webhook_task_queue also takes."""
+        lock_ttl = getattr(QUEUE_POLICIES.get(self.queue_name, object()), 'lock_ttl_seconds', 120) or 120
+        deadline = time.monotonic() + (lock_ttl if self.LOCK_WAIT is None else self.LOCK_WAIT)
+        while not await self.redis.set_lock(lock_key, ttl_seconds=lock_ttl):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.LOCK_RETRY_INTERVAL)
+        return True
+    
+    async def handle_retry(self, message_data: Dict[str, Any], error: Exception):
+        """Retry through the same attempts/backoff/failed path as poll_webhook_task_queue."""
+        logger.warning(f"Webhook task not applied, retrying", 
+                       event_id=message_data.get("event_id"),
+                       attempts=message_data.get("attempts", 0),
+                       error=str(error))
+        await retry_webhook_task(message_data)
+    
     async def process_message(self, message: Dict[str, Any]) -> bool:
         """Process webhook-related messages."""
+        if "event_id" not in message:
+            logger.warning(f"Unknown webhook message type: {message}")
+            return False
+        
+        # Events for one subscription are applied one at a time across workers
+        subscription_id = self.ordering_key(message)
+        lock_key = f"lock:subscription:{subscription_id}" if subscription_id else None
+        if lock_key and not await self._acquire_subscription_lock(lock_key):
+            logger.warning(f"Timed out waiting for subscription lock", lock_key=lock_key)
+            return False
+        
         try:
             async with AsyncSessionLocal() as session:
                 service = WebhookService(session)
-                
-                # Handle webhook processing
-                if "event_id" in message:
-                    event_id = message["event_id"]
-                    payload = message
-                    success = await service.process_webhook_event(event_id, payload)
-                    return success
-                
-                logger.warning(f"Unknown webhook message type: {message}")
-                return False
-                
+                return await service.process_webhook_event(message["event_id"], message)
         except Exception as e:
             logger.error(f"Error processing webhook message: {e}")
             return False
+        finally:
+            if lock_key:
+                await self.redis.release_lock(lock_key)
+    
+    async def process_batch(self, raw_messages: List[str]):
+        """Process a popped batch, then flush its buffered subscription events."""
+        await super().process_batch(raw_messages)
+        
+        if raw_messages and settings.SUBSCRIPTION_EVENT_OUTBOX:
+            # Same as the beat poll: land the batch's events in one multi-row
+            # insert rather than waiting for the outbox beat
+            from app.services.subscription_service import SubscriptionService
+            try:
+                async with AsyncSessionLocal() as session:
+                    await SubscriptionService(session).flush_event_outbox()
+            except Exception as e:
+                # Entries were requeued; the scheduled flush will retry them
+                logger.error(f"Error flushing subscription events after webhook batch: {e}")
 
 
 @celery_app.task(bind=True, max_retries=5)
@@ -51,7 +106,7 @@ def process_webhook_processing(self, message_data: str):
                 service = WebhookService(session)
                 return await service.process_webhook_event(event_id, payload)
         
-        success = asyncio.run(run_processing())
+        success = run_async(run_processing())
         
         if success:
             logger.info(f"Webhook processing completed for event {event_id}")
@@ -75,9 +130,16 @@ def retry_failed_webhooks(self):
                 # Implementation depends on webhook service design
                 logger.info("Checking for failed webhooks to retry")
         
-        asyncio.run(run_retry())
+        run_async(run_retry())
         logger.info("Failed webhook retry check completed")
         
     except Exception as e:
         logger.error(f"Failed webhook retry failed: {e}")
-        raise 
\ No newline at end of file
+        raise
+
+
+if __name__ == "__main__":
+    # Long-running consumer for WEBHOOK_LONG_POLL_CONSUMER deployments:
+    # blocks on the webhook task queue rather than waiting for a beat tick.
+    # Per-subscription ordering is kept within the process, so run one.
+    WebhookConsumer(WEBHOOK_PROCESSING_QUEUE).run_sync_consumer()
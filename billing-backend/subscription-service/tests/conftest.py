@@ -14,7 +14,7 @@ from app.models.user import User
 from app.models.plan import Plan
 from app.models.subscription import Subscription
 from app.schemas.subscription import SubscriptionCreateRequest, TrialSubscriptionRequest
-from app.schemas.auth import UserRegisterRequest, UserLoginRequest
+from app.schemas.auth import RegisterRequest, LoginRequest
 from app.schemas.usage import UsageCheckResponse
 from app.core.redis_client import RedisClient
 
@@ -180,7 +180,7 @@ def trial_subscription_request(sample_trial_plan):
 @pytest.fixture
 def user_register_request():
     """Sample user registration request."""
-    return UserRegisterRequest(
+    return RegisterRequest(
         email="newuser@example.com",
         password="password123",
         first_name="New",
@@ -191,7 +191,7 @@ def user_register_request():
 @pytest.fixture
 def user_login_request():
     """Sample user login request."""
-    return UserLoginRequest(
+    return LoginRequest(
         email="test@example.com",
         password="password123"
     )
@@ -225,6 +225,7 @@ def mock_subscription_repo():
     repo.create = AsyncMock()
     repo.get_by_id = AsyncMock()
     repo.get_active_subscription_by_user = AsyncMock()
+    repo.get_open_subscription_states = AsyncMock(return_value=[])
     repo.get_user_subscriptions = AsyncMock()
     repo.update = AsyncMock()
     return repo
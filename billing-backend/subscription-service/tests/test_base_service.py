@@ -0,0 +1,59 @@
+"""
+Unit tests for BaseService unit-of-work handling.
+"""
+import pytest
+from unittest.mock import AsyncMock, MagicMock, call, patch
+from uuid import uuid4
+
+from app.services.base_service import BaseService
+
+
+class TestBaseServiceCommit:
+    """Test cases for event rows written by BaseService.commit()."""
+
+    @pytest.fixture
+    def service(self, mock_session, mock_redis, mock_subscription_repo):
+        """Create base service with mocked dependencies."""
+        service = BaseService(mock_session)
+        service.redis = mock_redis
+        service.subscription_repo = mock_subscription_repo
+        service.subscription_repo.bulk_insert_events = AsyncMock()
+        return service
+
+    @pytest.mark.asyncio
+    async def test_commit_flushes_then_inserts_event_rows(self, service):
+        """Test that queued event rows are inserted after a flush and before COMMIT."""
+        event = {"subscription_id": uuid4(), "event_type": "created", "event_metadata": {}}
+        order = MagicMock()
+        order.attach_mock(service.session.flush, "flush")
+        order.attach_mock(service.subscription_repo.bulk_insert_events, "bulk_insert_events")
+        order.attach_mock(service.session.commit, "commit")
+
+        with patch("app.services.base_service.settings.SUBSCRIPTION_EVENT_OUTBOX", False):
+            service._record_event(event)
+            await service.commit()
+
+        assert order.mock_calls == [call.flush(), call.bulk_insert_events([event]), call.commit()]
+        assert service._pending_event_rows == []
+
+    @pytest.mark.asyncio
+    async def test_commit_without_events_skips_insert(self, service):
+        """Test that a commit with no queued events issues no insert."""
+        await service.commit()
+
+        service.subscription_repo.bulk_insert_events.assert_not_called()
+        service.session.commit.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_commit_failure_discards_event_rows(self, service):
+        """Test that a failed insert rolls back and drops the queued rows."""
+        service.subscription_repo.bulk_insert_events.side_effect = Exception("insert failed")
+
+        with patch("app.services.base_service.settings.SUBSCRIPTION_EVENT_OUTBOX", False):
+            service._record_event({"subscription_id": uuid4(), "event_type": "created"})
+            with pytest.raises(Exception, match="insert failed"):
+                await service.commit()
+
+        service.session.rollback.assert_called_once()
+        service.session.commit.assert_not_called()
+        assert service._pending_event_rows == []
@@ -0,0 +1,125 @@
+"""
+Unit tests for claim-and-lock queue processing.
+"""
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.core.redis_client import RedisClient
+from app.workers.queue_processor import _claim_lock_process
+
+QUEUE = "q:sub:payment_initiation"
+LOCK_KEY = f"lock:{QUEUE}:msg-1"
+
+
+class TestClaimAndLockBatch:
+    """Test cases for RedisClient.claim_and_lock_batch."""
+
+    @pytest.mark.asyncio
+    async def test_results_keyed_by_queue(self):
+        """Test that one script call per queue is pipelined and results map back to queues."""
+        client = RedisClient()
+        pipe = MagicMock()
+        pipe.execute = AsyncMock(return_value=[
+            None,
+            ["locked", "lock:q:b:abc"],
+            ["ok", '{"id": "abc"}', "lock:q:c:abc"]
+        ])
+        client.client = MagicMock()
+        client.client.pipeline.return_value = pipe
+        client._claim_and_lock = AsyncMock()
+
+        result = await client.claim_and_lock_batch({"q:a": 60, "q:b": 120, "q:c": 30})
+
+        assert result == {
+            "q:a": None,
+            "q:b": ["locked", "lock:q:b:abc"],
+            "q:c": ["ok", '{"id": "abc"}', "lock:q:c:abc"]
+        }
+        client.client.pipeline.assert_called_once_with(transaction=False)
+        assert client._claim_and_lock.call_count == 3
+        client._claim_and_lock.assert_any_call(
+            keys=["q:b", "q:b:processing"], args=["lock:q:b:", 120], client=pipe
+        )
+        pipe.execute.assert_called_once()
+
+
+class TestClaimLockProcess:
+    """Test cases for _claim_lock_process result handling."""
+
+    @pytest.fixture
+    def redis(self, mock_redis):
+        """Patch the worker's Redis client with an async mock."""
+        mock_redis.claim_and_lock = AsyncMock()
+        mock_redis.remove_from_processing = AsyncMock()
+        mock_redis.release_lock = AsyncMock()
+        mock_redis.queue_delayed_message = AsyncMock()
+        with patch("app.workers.queue_processor.redis_client", mock_redis):
+            yield mock_redis
+
+    @pytest.mark.asyncio
+    async def test_empty_queue(self, redis):
+        """Test that an empty queue reports no_message without calling the handler."""
+        handler = AsyncMock()
+
+        result = await _claim_lock_process(QUEUE, handler, "payment", claimed=None)
+
+        assert result == "no_message"
+        redis.claim_and_lock.assert_called_once()
+        handler.assert_not_called()
+        redis.release_lock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_locked_message(self, redis):
+        """Test that a message locked elsewhere is left to the script's requeue."""
+        handler = AsyncMock()
+
+        result = await _claim_lock_process(QUEUE, handler, "payment", claimed=["locked", LOCK_KEY])
+
+        assert result == "retry"
+        handler.assert_not_called()
+        redis.claim_and_lock.assert_not_called()
+        redis.release_lock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_handler_success(self, redis):
+        """Test that a handled message leaves processing and its lock is released."""
+        msg = json.dumps({"id": "msg-1", "payload": {}})
+        handler = AsyncMock(return_value={"status": "processed"})
+
+        result = await _claim_lock_process(QUEUE, handler, "payment", claimed=["ok", msg, LOCK_KEY])
+
+        assert result == {"status": "processed"}
+        handler.assert_called_once_with(msg)
+        redis.remove_from_processing.assert_called_once_with(f"{QUEUE}:processing", msg)
+        redis.queue_delayed_message.assert_not_called()
+        redis.release_lock.assert_called_once_with(LOCK_KEY)
+
+    @pytest.mark.asyncio
+    async def test_handler_failure_retries_with_backoff(self, redis):
+        """Test that a failed message is delayed with its attempt count bumped."""
+        msg = json.dumps({"id": "msg-1", "attempts": 0})
+        handler = AsyncMock(side_effect=Exception("boom"))
+
+        result = await _claim_lock_process(QUEUE, handler, "payment", claimed=["ok", msg, LOCK_KEY])
+
+        assert result == "retry"
+        redis.remove_from_processing.assert_called_once_with(f"{QUEUE}:processing", msg)
+        redis.queue_delayed_message.assert_called_once()
+        queue_name, message = redis.queue_delayed_message.call_args[0]
+        assert queue_name == QUEUE
+        assert message["attempts"] == 1
+        redis.release_lock.assert_called_once_with(LOCK_KEY)
+
+    @pytest.mark.asyncio
+    async def test_handler_failure_exhausted_moves_to_failed(self, redis):
+        """Test that a message past its retry budget lands on the failed queue."""
+        msg = json.dumps({"id": "msg-1", "attempts": 1000})
+        handler = AsyncMock(side_effect=Exception("boom"))
+
+        result = await _claim_lock_process(QUEUE, handler, "payment", claimed=["ok", msg, LOCK_KEY])
+
+        assert result == "failed"
+        redis.queue_delayed_message.assert_not_called()
+        redis.client.lpush.assert_called_once_with(f"{QUEUE}:failed", msg)
+        redis.release_lock.assert_called_once_with(LOCK_KEY)
@@ -5,6 +5,7 @@ import pytest
 import pytest_asyncio
 from unittest.mock import AsyncMock, patch
 from datetime import datetime, timedelta
+import time
 from uuid import uuid4
 
 from app.services.usage_service import UsageService
@@ -23,6 +24,65 @@ class TestUsageService:
         service.usage_repo = mock_usage_repo
         return service
 
+    @pytest.mark.asyncio
+    async def test_active_sub_cache_hit(self, service):
+        """Test that an unexpired cached summary skips the subscription query."""
+        # Setup mocks
+        service.redis.get_active_sub = AsyncMock(return_value={
+            "subscription_id": "sub-1",
+            "plan_id": "1",
+            "status": "active",
+            "end_ts": str(int(time.time()) + 3600),
+            "limits_json": '{"api_calls": 1000}'
+        })
+
+        # Execute
+        result = await service._get_active_sub_cached(1)
+
+        # Verify
+        assert result["plan_id"] == 1
+        assert result["limits"] == {"api_calls": 1000}
+        service.subscription_repo.get_active_subscription_summary.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_active_sub_cache_hit_past_end_is_miss(self, service):
+        """Test that a cached summary past the subscription's end is reloaded."""
+        # Setup mocks
+        service.redis.get_active_sub = AsyncMock(return_value={
+            "subscription_id": "sub-1",
+            "plan_id": "1",
+            "status": "active",
+            "end_ts": str(int(time.time()) - 1),
+            "limits_json": "{}"
+        })
+        service.redis.set_active_sub = AsyncMock()
+        service.subscription_repo.get_active_subscription_summary = AsyncMock(return_value=None)
+
+        # Execute
+        result = await service._get_active_sub_cached(1)
+
+        # Verify
+        assert result is None
+        service.subscription_repo.get_active_subscription_summary.assert_called_once_with(1)
+        service.redis.set_active_sub.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_active_sub_cache_ttl_capped_at_end(self, service):
+        """Test that the cache entry does not outlive the subscription."""
+        # Setup mocks
+        service.redis.get_active_sub = AsyncMock(return_value={})
+        service.redis.set_active_sub = AsyncMock()
+        service.subscription_repo.get_active_subscription_summary = AsyncMock(return_value=(
+            uuid4(), 1, "active", datetime.utcnow() + timedelta(seconds=30), {"api_calls": 1000}
+        ))
+
+        # Execute
+        await service._get_active_sub_cached(1)
+
+        # Verify
+        ttl = service.redis.set_active_sub.call_args[0][2]
+        assert 0 < ttl <= 30
+
     @pytest.mark.asyncio
     async def test_use_feature_success(self, service, sample_subscription):
         """Test successful feature usage."""
@@ -0,0 +1,101 @@
+"""
+Unit tests for the long-poll WebhookConsumer.
+"""
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+
+import orjson
+
+from app.workers.webhook_consumer import WebhookConsumer
+from app.core.redis_client import WEBHOOK_PROCESSING_QUEUE
+
+
+class TestWebhookConsumer:
+    """Test cases for WebhookConsumer."""
+
+    @pytest.fixture
+    def consumer(self, mock_redis):
+        """Create webhook consumer with mocked Redis."""
+        consumer = WebhookConsumer(WEBHOOK_PROCESSING_QUEUE)
+        consumer.redis = mock_redis
+        consumer.redis.set_lock = AsyncMock(return_value=True)
+        consumer.redis.release_lock = AsyncMock()
+        return consumer
+
+    def test_ordering_key_reads_payload_subscription_id(self):
+        """Test that webhook tasks are ordered by the subscription in their payload."""
+        subscription_id = uuid4()
+        message = {"event_id": "evt-1", "payload": {"subscription_id": str(subscription_id)}}
+
+        assert WebhookConsumer.ordering_key(message) == str(subscription_id)
+
+    def test_ordering_key_falls_back_to_top_level(self):
+        """Test that a top-level subscription_id is used when the payload has none."""
+        message = {"event_id": "evt-1", "payload": {}, "subscription_id": "sub-1"}
+
+        assert WebhookConsumer.ordering_key(message) == "sub-1"
+
+    def test_ordering_key_none_without_subscription(self):
+        """Test that messages without a subscription are unordered."""
+        assert WebhookConsumer.ordering_key({"event_id": "evt-1"}) is None
+
+    @pytest.mark.asyncio
+    async def test_process_message_takes_subscription_lock(self, consumer):
+        """Test that processing holds the same lock as the beat poll and releases it."""
+        message = {"event_id": "evt-1", "payload": {"subscription_id": "sub-1"}}
+        service = MagicMock()
+        service.process_webhook_event = AsyncMock(return_value=True)
+
+        with patch("app.workers.webhook_consumer.AsyncSessionLocal", MagicMock()), \
+             patch("app.workers.webhook_consumer.WebhookService", return_value=service):
+            result = await consumer.process_message(message)
+
+        assert result is True
+        consumer.redis.set_lock.assert_called_once()
+        assert consumer.redis.set_lock.call_args[0][0] == "lock:subscription:sub-1"
+        consumer.redis.release_lock.assert_called_once_with("lock:subscription:sub-1")
+        service.process_webhook_event.assert_called_once_with("evt-1", message)
+
+    @pytest.mark.asyncio
+    async def test_process_message_lock_timeout(self, consumer):
+        """Test that a message is retried when the subscription lock never frees up."""
+        consumer.redis.set_lock = AsyncMock(return_value=False)
+        consumer.LOCK_WAIT = 0
+        message = {"event_id": "evt-1", "payload": {"subscription_id": "sub-1"}}
+
+        result = await consumer.process_message(message)
+
+        assert result is False
+        consumer.redis.release_lock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_handle_retry_uses_queue_policy_backoff(self, consumer):
+        """Test that failures are delayed with the poller's attempts counter."""
+        message = {"event_id": "evt-1", "payload": {"subscription_id": "sub-1"}}
+        redis = MagicMock()
+        redis.queue_delayed_message = AsyncMock()
+
+        with patch("app.workers.queue_processor.redis_client", redis):
+            await consumer.handle_retry(message, Exception("boom"))
+
+        queue_name, retried = redis.queue_delayed_message.call_args[0]
+        assert queue_name == WEBHOOK_PROCESSING_QUEUE
+        assert retried["attempts"] == 1
+        assert "retry_count" not in retried
+
+    @pytest.mark.asyncio
+    async def test_handle_retry_exhausted_pushes_raw_task_to_failed(self, consumer):
+        """Test that an exhausted task lands on :failed as the raw task, not a FailedMsg."""
+        message = {"event_id": "evt-1", "payload": {}, "attempts": 1000}
+        redis = MagicMock()
+        redis.queue_delayed_message = AsyncMock()
+        redis.client.lpush = AsyncMock()
+
+        with patch("app.workers.queue_processor.redis_client", redis):
+            await consumer.handle_retry(message, Exception("boom"))
+
+        redis.queue_delayed_message.assert_not_called()
+        failed_queue, failed = redis.client.lpush.call_args[0]
+        assert failed_queue == f"{WEBHOOK_PROCESSING_QUEUE}:failed"
+        assert orjson.loads(failed) == message
@@ -4,7 +4,8 @@ Unit tests for WebhookService business logic.
 import pytest
 import pytest_asyncio
 from unittest.mock import AsyncMock, patch, MagicMock
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import inspect
 from uuid import uuid4
 
 from app.services.webhook_service import WebhookService
@@ -231,6 +232,26 @@ class TestWebhookService:
         assert "end_date" in update_data
         # End date should be extended based on billing cycle
 
+    @pytest.mark.asyncio
+    async def test_success_renewal_does_not_dirty_subscription(self, service, sample_subscription):
+        """Test that renewal writes the new end date via UPDATE only."""
+        # Setup mocks
+        sample_subscription.status = "active"
+        old_end_date = sample_subscription.end_date
+        service.subscription_repo.update.return_value = AsyncMock()
+
+        # Execute
+        event_type, metadata, _, _ = await service._success_renewal(sample_subscription, 29.99)
+
+        # Verify the UPDATE carries the extended date and the instance matches without pending changes
+        expected_end_date = old_end_date + timedelta(days=30)
+        assert event_type == "renewed"
+        service.subscription_repo.update.assert_called_once_with(
+            sample_subscription.id, {"end_date": expected_end_date}
+        )
+        assert sample_subscription.end_date == expected_end_date
+        assert not inspect(sample_subscription).attrs.end_date.history.has_changes()
+
     @pytest.mark.asyncio
     async def test_handle_payment_failure_pending_subscription(self, service, sample_subscription):
         """Test handling failed payment for pending subscription."""